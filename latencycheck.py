@@ -0,0 +1,571 @@
+# Offline latency and throughput checks for main.py.
+#
+# Each check drives the real code against an in-process fake Telegram and a
+# seeded temporary database, prints what it measured and PASS/FAIL against a
+# threshold, and the script exits 1 if any check failed:
+#
+#   startup    import time of main.py, and that Telethon stays unloaded
+#   metrics    cost of one histogram observation and of a /metrics scrape
+#   start      /start throughput and latency for many concurrent users
+#   otp        OTP handling in message_handler, idle and while stats,
+#              audience counts and broadcast pages run over --users rows
+#   prewarm    phone number to OTP prompt, cold handshake vs pre-warmed key
+#   broadcast  send rate against the token bucket and the old one-at-a-time
+#              loop, on the same fake client
+#   promotion  get_me() calls per job and send calls per recipient
+#   memory     Python heap of a job at 1x and 4x the users
+#
+#   python latencycheck.py --users 1000000 otp
+#
+# Restart-to-ready of the bot client needs the real Telegram, see the
+# startup_phase_seconds gauge on /metrics for that.
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import datetime
+import itertools
+import subprocess
+import tracemalloc
+
+CHECKS = ("startup", "metrics", "start", "otp", "prewarm", "broadcast", "promotion", "memory")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Latency and throughput checks against a fake Telegram")
+    parser.add_argument("checks", nargs="*", metavar="check",
+                        help=f"checks to run: {', '.join(CHECKS)} (default: all)")
+    parser.add_argument("--users", type=int, default=1_000_000, help="users seeded for the otp check")
+    parser.add_argument("--probes", type=int, default=100, help="OTP flows measured per otp/prewarm phase")
+    parser.add_argument("--ramp", type=float, default=5.0, help="seconds over which the probes arrive")
+    parser.add_argument("--latency", type=float, default=30.0, help="mean MTProto call latency (ms)")
+    parser.add_argument("--bot-latency", type=float, default=5.0, help="mean latency of the bot's own replies (ms)")
+    parser.add_argument("--handshake", type=float, default=300.0, help="extra connect() time without an auth key (ms)")
+    parser.add_argument("--jitter", type=float, default=0.5, help="latency varies uniformly by +/- this fraction")
+    parser.add_argument("--session-backend", choices=("memory", "sqlite"), default="memory")
+    parser.add_argument("--max-slowdown", type=float, default=0.1,
+                        help="allowed p99 OTP latency increase under database load (s)")
+    parser.add_argument("--max-lag", type=float, default=0.1, help="allowed event loop lag (s)")
+    parser.add_argument("--max-import", type=float, default=1.5,
+                        help="allowed time to import main.py in a fresh interpreter (s)")
+    parser.add_argument("--start-users", type=int, default=5000, help="concurrent /start senders")
+    parser.add_argument("--workers", type=int, default=min(32, (os.cpu_count() or 0) + 4),
+                        help="updates handled at once, Pyrogram's default is min(32, cpu + 4)")
+    parser.add_argument("--broadcast-users", type=int, default=2000,
+                        help="recipients of a job, the memory check also runs one with 4x as many")
+    parser.add_argument("--baseline-users", type=int, default=100,
+                        help="recipients of the old one-at-a-time loop, which manages under 10/s")
+    parser.add_argument("--rate", type=float, default=1000.0, help="BROADCAST_RATE for the broadcast check")
+    parser.add_argument("--concurrency", type=int, default=50, help="BROADCAST_CONCURRENCY for the broadcast check")
+    parser.add_argument("--max-heap-growth", type=float, default=1.5,
+                        help="allowed heap peak ratio between the 4x and the 1x job")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's own logging")
+    parsed = parser.parse_args()
+    unknown = [name for name in parsed.checks if name not in CHECKS]
+    if unknown:
+        parser.error(f"unknown check: {', '.join(unknown)}")
+    parsed.checks = parsed.checks or list(CHECKS)
+    return parsed
+
+args = parse_args()
+
+# main.py reads its configuration at import time
+workdir = tempfile.mkdtemp(prefix="latencycheck-")
+os.environ["DB_PATH"] = os.path.join(workdir, "users.db")
+os.environ["SESSION_BACKEND"] = args.session_backend
+os.environ["PREWARM_POOL_SIZE"] = "0"
+os.environ["BROADCAST_RATE"] = str(args.rate)
+os.environ["BROADCAST_BURST"] = str(args.concurrency)
+os.environ["BROADCAST_CONCURRENCY"] = str(args.concurrency)
+os.environ.pop("BOT_SESSION_DIR", None)
+
+if "startup" in args.checks:
+    # Measured in a fresh interpreter, before this one imports anything heavy
+    probe = subprocess.run(
+        [sys.executable, "-c",
+         "import sys, time; started = time.perf_counter(); import main; "
+         "print(time.perf_counter() - started, 'telethon' in sys.modules)"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True
+    )
+    startup_probe = probe.stdout.split() if probe.returncode == 0 else None
+    startup_error = probe.stderr.strip().splitlines()[-1:] if probe.returncode else []
+
+import main
+
+if not args.verbose:
+    logging.getLogger().setLevel(logging.WARNING)
+
+rng = random.Random(args.seed)
+failures = []
+
+def delay(mean_ms):
+    return max(0.0, mean_ms / 1000 * rng.uniform(1 - args.jitter, 1 + args.jitter))
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def check(ok, text):
+    print(f"{'PASS' if ok else 'FAIL'}  {text}")
+    if not ok:
+        failures.append(text)
+
+def info(text):
+    print(f"      {text}")
+
+# Fake Telegram
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.username = f"user{user_id}"
+        self.first_name = "Check"
+        self.last_name = None
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+        self.replies = []
+        self.replied = asyncio.Event()
+
+    def add(self, text):
+        self.replies.append(text)
+        self.replied.set()
+
+    async def wait_for(self, needle, start=0):
+        # First reply from index `start` on containing needle, or an error
+        while True:
+            for text in self.replies[start:]:
+                if needle in text or text.startswith("❌"):
+                    return text
+            start = len(self.replies)
+            self.replied.clear()
+            await self.replied.wait()
+
+class FakeMessage:
+    next_id = 1
+    # Total time spent in the bot's fake replies
+    reply_seconds = 0.0
+
+    def __init__(self, user, chat, text=""):
+        self.id = FakeMessage.next_id
+        FakeMessage.next_id += 1
+        self.from_user = user
+        self.chat = chat
+        self.text = text
+        self.command = text[1:].split() if text.startswith("/") else None
+        self.reply_to_message = None
+
+    async def reply_text(self, text, **kwargs):
+        seconds = delay(args.bot_latency)
+        FakeMessage.reply_seconds += seconds
+        await asyncio.sleep(seconds)
+        self.chat.add(text)
+        return FakeMessage(self.from_user, self.chat, text)
+
+class FakeBot:
+    # The main bot client; counts the API calls a job makes
+    def __init__(self, send_latency):
+        self.send_latency = send_latency
+        self.calls = {}
+
+    def count(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.count("send_message")
+        await asyncio.sleep(delay(self.send_latency))
+
+    async def copy_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        self.count("copy_message")
+        await asyncio.sleep(delay(self.send_latency))
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        self.count("edit_message_text")
+
+    async def get_me(self):
+        self.count("get_me")
+        await asyncio.sleep(delay(self.send_latency))
+        return FakeUser(1)
+
+class FakeSentCode:
+    phone_code_hash = "0123456789abcdef"
+
+class FakeSession:
+    def save(self):
+        return "1" + "A" * 352
+
+class FakeStorage:
+    async def dc_id(self):
+        return 2
+
+    async def test_mode(self):
+        return False
+
+    async def auth_key(self):
+        return bytes(256)
+
+class FakeLoginClient:
+    # Answers both the Pyrogram and the Telethon calls main.py makes; a
+    # client created without an auth key pays for the key exchange
+    def __init__(self, warm):
+        self.warm = warm
+        self.is_connected = False
+        self.session = FakeSession()
+        self.storage = FakeStorage()
+
+    async def connect(self):
+        await asyncio.sleep(delay(args.latency) + (0 if self.warm else delay(args.handshake)))
+        self.is_connected = True
+
+    async def disconnect(self):
+        self.is_connected = False
+
+    async def send_code(self, phone):
+        await asyncio.sleep(delay(args.latency))
+        return FakeSentCode()
+
+    async def send_code_request(self, phone):
+        return await self.send_code(phone)
+
+    async def sign_in(self, *params, code=None, password=None, **kwargs):
+        await asyncio.sleep(delay(args.latency))
+
+    async def export_session_string(self):
+        await asyncio.sleep(delay(args.latency))
+        return "B" * 351
+
+    async def send_message(self, chat_id, text):
+        await asyncio.sleep(delay(args.latency))
+
+def install_fakes():
+    def pyrogram_client(name, api_id, api_hash, session_string=None, **kwargs):
+        return FakeLoginClient(bool(session_string))
+
+    async def telethon_client(session_string, api_id, api_hash):
+        return FakeLoginClient(bool(session_string))
+
+    main.create_pyrogram_client = pyrogram_client
+    main.create_telethon_client = telethon_client
+    # Nothing to import, the fake stands in for Telethon
+    main.telethon_classes = {}
+
+class LagMonitor:
+    # Worst delay of a short sleep, i.e. how long the loop was held
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.worst = 0.0
+        self.task = None
+
+    async def run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.worst = max(self.worst, time.perf_counter() - started - self.interval)
+
+    def __enter__(self):
+        self.task = asyncio.create_task(self.run())
+        return self
+
+    def __exit__(self, *exc):
+        self.task.cancel()
+
+# Seeding
+
+SEED_USER_SQL = """INSERT INTO users (user_id, username, first_name, last_name, date_joined, last_seen)
+    VALUES (?, ?, 'Seed', NULL, ?, ?)"""
+
+def seed_users(store, first_id, count):
+    # Joined over the last two years, seen some time after joining
+    now = datetime.datetime.utcnow()
+    days = [(now - datetime.timedelta(days=day)).strftime("%Y-%m-%d %H:%M:%S") for day in range(731)]
+    seeder = random.Random(args.seed)
+
+    def rows():
+        for user_id in range(first_id, first_id + count):
+            joined = seeder.randrange(731)
+            yield user_id, f"user{user_id}", days[joined], days[seeder.randrange(joined + 1)]
+
+    def write():
+        with store.conn:
+            store.conn.executemany(SEED_USER_SQL, rows())
+        store.conn.execute("ANALYZE")
+
+    return store.run(write)
+
+# Checks
+
+async def check_startup():
+    print("startup")
+    if startup_probe is None:
+        check(False, f"import main in a fresh interpreter failed: {' '.join(startup_error)}")
+        return
+    seconds, telethon_loaded = float(startup_probe[0]), startup_probe[1] == "True"
+    check(seconds <= args.max_import, f"import main takes {seconds:.3f}s (<= {args.max_import:g}s)")
+    check(not telethon_loaded, "Telethon is not imported until a Telethon flow needs it")
+
+async def check_metrics():
+    print("metrics")
+    histogram = main.Histogram("latencycheck_seconds", "Scratch histogram", ("handler", "kind"))
+    count = 100_000
+    started = time.perf_counter()
+    for index in range(count):
+        histogram.observe(index / count, handler="message_handler", kind="otp")
+    per_observation = (time.perf_counter() - started) / count
+    started = time.perf_counter()
+    await main.metrics_page()
+    scrape = time.perf_counter() - started
+    main.metrics_registry.remove(histogram)
+    check(per_observation < 20e-6, f"histogram observation takes {per_observation * 1e6:.2f}µs (< 20µs)")
+    check(scrape < 0.05, f"/metrics scrape takes {scrape * 1000:.1f}ms (< 50ms)")
+
+async def check_start():
+    print("start")
+    bot = FakeBot(args.bot_latency)
+    first_id = 2_000_000_000
+    slots = asyncio.Semaphore(args.workers)
+    latencies = []
+
+    async def send_start(user_id):
+        user = FakeUser(user_id)
+        queued = time.perf_counter()
+        async with slots:
+            await main.start_command(bot, FakeMessage(user, FakeChat(user_id), "/start"))
+        latencies.append(time.perf_counter() - queued)
+
+    main.registration_queue.start()
+    FakeMessage.reply_seconds = 0.0
+    started = time.perf_counter()
+    with LagMonitor() as lag:
+        await asyncio.gather(*(send_start(first_id + index) for index in range(args.start_users)))
+    wall = time.perf_counter() - started
+    await main.registration_queue.stop()
+    stored = (await main.user_store.fetchone(
+        "SELECT COUNT(*) FROM users WHERE user_id >= ?", (first_id,)
+    ))[0]
+    # With every worker busy only waiting on Telegram, the fake's own time
+    # spread over the workers is as fast as it can go
+    ideal = FakeMessage.reply_seconds / args.workers
+    info(f"{args.start_users} /start in {wall:.2f}s ({args.start_users / wall:.0f}/s), "
+         f"p50 {percentile(latencies, 0.5) * 1000:.1f}ms, p99 {percentile(latencies, 0.99) * 1000:.1f}ms")
+    check(ideal >= 0.8 * wall, f"/start throughput is {ideal / wall:.0%} of what {args.workers} workers "
+          f"waiting only on Telegram would reach (>= 80%)")
+    check(stored == args.start_users, f"every /start user was stored ({stored}/{args.start_users})")
+    check(lag.worst <= args.max_lag, f"event loop lag {lag.worst * 1000:.1f}ms (<= {args.max_lag * 1000:g}ms)")
+
+async def login_flow(bot, user_id, library="pyrogram"):
+    # Phone number to OTP prompt, then OTP to the finished session
+    user = FakeUser(user_id)
+    chat = FakeChat(user_id)
+    await main.save_session(user_id, {
+        "library": library, "step": "auth_data", "api_id": 1, "api_hash": "0123456789abcdef0123456789abcdef"
+    })
+    started = time.perf_counter()
+    await main.message_handler(bot, FakeMessage(user, chat, f"+1555{user_id % 10_000_000:07d}"))
+    reply = await chat.wait_for("OTP sent")
+    if reply.startswith("❌"):
+        raise RuntimeError(reply.splitlines()[0])
+    prompt = time.perf_counter() - started
+    seen = len(chat.replies)
+    started = time.perf_counter()
+    # Timed to the reply the user sees; the handler goes on to record the
+    # generation and close the client after that
+    handler = asyncio.create_task(main.message_handler(bot, FakeMessage(user, chat, "1 2 3 4 5")))
+    reply = await chat.wait_for("Session generated successfully", seen)
+    otp = time.perf_counter() - started
+    await handler
+    if reply.startswith("❌"):
+        raise RuntimeError(reply.splitlines()[0])
+    return prompt, otp
+
+async def run_probes(bot, first_id, libraries=("pyrogram",)):
+    async def probe(index):
+        await asyncio.sleep(rng.uniform(0, args.ramp))
+        return await login_flow(bot, first_id + index, libraries[index % len(libraries)])
+
+    return await asyncio.gather(*(probe(index) for index in range(args.probes)))
+
+async def check_otp():
+    print("otp")
+    bot = FakeBot(args.bot_latency)
+    started = time.perf_counter()
+    await seed_users(main.user_store, 1, args.users)
+    info(f"seeded {args.users} users in {time.perf_counter() - started:.1f}s")
+
+    with LagMonitor() as idle_lag:
+        idle = [otp for _, otp in await run_probes(bot, 3_000_000_000)]
+
+    # The queries behind /stats, a segment count and a broadcast's recipient
+    # pages, each run back to back until the probes are done
+    segment, _ = main.parse_segment("seen=365 ")
+    queries = {}
+
+    async def walk_recipients():
+        async for _ in main.user_store.iter_job_recipients(0, -1 << 63):
+            pass
+
+    async def load(name, work, stop):
+        while not stop.is_set():
+            started = time.perf_counter()
+            await work()
+            queries.setdefault(name, []).append(time.perf_counter() - started)
+
+    stop = asyncio.Event()
+    loaders = [
+        asyncio.create_task(load("stats", main.stats_text, stop)),
+        asyncio.create_task(load("audience count", lambda: main.user_store.count_audience(segment), stop)),
+        asyncio.create_task(load("recipient walk", walk_recipients, stop)),
+    ]
+    try:
+        with LagMonitor() as loaded_lag:
+            loaded = [otp for _, otp in await run_probes(bot, 3_100_000_000)]
+    finally:
+        stop.set()
+        await asyncio.gather(*loaders)
+
+    for name, durations in queries.items():
+        info(f"{name}: {len(durations)} runs, max {max(durations):.3f}s")
+    idle_p99, loaded_p99 = percentile(idle, 0.99), percentile(loaded, 0.99)
+    info(f"OTP to session idle: p50 {percentile(idle, 0.5) * 1000:.1f}ms, p99 {idle_p99 * 1000:.1f}ms")
+    info(f"OTP to session under load: p50 {percentile(loaded, 0.5) * 1000:.1f}ms, p99 {loaded_p99 * 1000:.1f}ms")
+    check(loaded_p99 - idle_p99 <= args.max_slowdown,
+          f"OTP p99 rises {(loaded_p99 - idle_p99) * 1000:.1f}ms under database load "
+          f"(<= {args.max_slowdown * 1000:g}ms)")
+    worst = max(idle_lag.worst, loaded_lag.worst)
+    check(worst <= args.max_lag, f"event loop lag {worst * 1000:.1f}ms (<= {args.max_lag * 1000:g}ms)")
+
+async def check_prewarm():
+    print("prewarm")
+    bot = FakeBot(args.bot_latency)
+    libraries = ("pyrogram", "telethon")
+    cold = [prompt for prompt, _ in await run_probes(bot, 3_200_000_000, libraries)]
+
+    # One pre-generated key per probe, so none of them waits for a refill
+    pool = main.AuthKeyPool(args.probes, main.PREWARM_MAX_AGE)
+    main.auth_key_pool, saved_pool = pool, main.auth_key_pool
+    main.API_ID, main.API_HASH = 1, "0123456789abcdef0123456789abcdef"
+    pool.start()
+    try:
+        while sum(len(keys) for keys in pool.keys.values()) < 2 * args.probes:
+            await asyncio.sleep(0.05)
+        warm = [prompt for prompt, _ in await run_probes(bot, 3_300_000_000, libraries)]
+    finally:
+        await pool.stop()
+        main.auth_key_pool = saved_pool
+
+    cold_p50, warm_p50 = percentile(cold, 0.5), percentile(warm, 0.5)
+    info(f"phone to OTP prompt, cold: p50 {cold_p50 * 1000:.1f}ms, p99 {percentile(cold, 0.99) * 1000:.1f}ms")
+    info(f"phone to OTP prompt, warm: p50 {warm_p50 * 1000:.1f}ms, p99 {percentile(warm, 0.99) * 1000:.1f}ms")
+    check(pool.hits == args.probes, f"every warm flow took a pre-generated key ({pool.hits}/{args.probes})")
+    check(cold_p50 - warm_p50 >= args.handshake / 2000,
+          f"pre-warmed keys save {(cold_p50 - warm_p50) * 1000:.1f}ms at p50 "
+          f"(>= half the {args.handshake:g}ms handshake)")
+
+job_files = itertools.count(1)
+
+async def run_job(kind, size, traced=False):
+    # A job over a fresh table of `size` users; returns the bot's call
+    # counts, wall time and Python heap peak
+    store = main.UserStore(os.path.join(workdir, f"job-{next(job_files)}.db"))
+    store.open()
+    saved_store, main.user_store = main.user_store, store
+    try:
+        await seed_users(store, 1, size)
+        bot = FakeBot(args.latency)
+        owner = FakeUser(main.OWNER_ID)
+        main.bot_profile.me = None
+        main.job_leader.leading = True
+        if traced:
+            tracemalloc.start()
+        started = time.perf_counter()
+        await main.start_job(bot, FakeMessage(owner, FakeChat(main.OWNER_ID)), kind, "latencycheck", "started")
+        await asyncio.gather(*main.broadcast_tasks.values())
+        wall = time.perf_counter() - started
+        heap_peak = tracemalloc.get_traced_memory()[1] if traced else None
+        if traced:
+            tracemalloc.stop()
+        return bot.calls, wall, heap_peak
+    finally:
+        main.job_leader.leading = False
+        main.user_store = saved_store
+        store.close()
+
+async def old_broadcast_loop(bot, user_ids):
+    # start_broadcast before the broadcast engine: one send at a time, a
+    # progress edit every 10 sends and a fixed 0.1s pause after each
+    sent = failed = 0
+    for user_id in user_ids:
+        try:
+            await bot.send_message(user_id, "📢 **Broadcast:**\n\nlatencycheck")
+            sent += 1
+        except Exception:
+            failed += 1
+        if sent % 10 == 0:
+            await bot.edit_message_text(main.OWNER_ID, 1, f"🔄 Broadcasting...\n{sent + failed}/{len(user_ids)}")
+        await asyncio.sleep(0.1)
+
+async def check_broadcast():
+    print("broadcast")
+    size = args.broadcast_users
+    calls, wall, _ = await run_job("broadcast", size)
+    rate = calls.get("send_message", 0) / wall
+    expected = min(args.rate, args.concurrency / (args.latency / 1000))
+
+    bot = FakeBot(args.latency)
+    started = time.perf_counter()
+    await old_broadcast_loop(bot, range(1, args.baseline_users + 1))
+    old_rate = bot.calls.get("send_message", 0) / (time.perf_counter() - started)
+
+    info(f"engine: {size} recipients in {wall:.2f}s, {rate:.0f} sends/s")
+    info(f"old loop: {args.baseline_users} recipients, {old_rate:.1f} sends/s")
+    check(rate >= 0.8 * expected, f"send rate {rate:.0f}/s reaches 80% of the {expected:.0f}/s limit")
+    check(rate > old_rate, f"the engine outsends the old loop on the same fake client ({rate / old_rate:.0f}x)")
+
+async def check_promotion():
+    print("promotion")
+    size = args.broadcast_users
+    calls, _, _ = await run_job("promotion", size)
+    sends = calls.get("send_message", 0)
+    check(calls.get("get_me", 0) <= 1, f"promotion calls get_me() {calls.get('get_me', 0)} time(s) per job")
+    check(sends == size, f"promotion makes {sends / size:.2f} send calls per recipient (1 expected)")
+
+async def check_memory():
+    print("memory")
+    size = args.broadcast_users
+    _, _, small_peak = await run_job("broadcast", size, traced=True)
+    _, _, large_peak = await run_job("broadcast", 4 * size, traced=True)
+    info(f"heap peak: {small_peak / 1024:.0f} KiB at {size} users, {large_peak / 1024:.0f} KiB at {4 * size}")
+    check(large_peak <= args.max_heap_growth * small_peak,
+          f"heap peak grows {large_peak / small_peak:.2f}x for 4x the users (<= {args.max_heap_growth:g}x)")
+
+async def run():
+    install_fakes()
+    main.live_clients.start()
+    main.private_sessions.start()
+    await main.session_backend.start()
+    try:
+        for name in CHECKS:
+            if name in args.checks:
+                await globals()[f"check_{name}"]()
+    finally:
+        await main.stop_logins()
+        await main.session_backend.stop()
+        await main.private_sessions.stop()
+        await main.live_clients.stop()
+
+if __name__ == "__main__":
+    main.user_store.open()
+    try:
+        asyncio.run(run())
+    finally:
+        main.user_store.close()
+    if failures:
+        print(f"{len(failures)} check(s) failed ({workdir})")
+        raise SystemExit(1)
+    print(f"All checks passed ({workdir})")
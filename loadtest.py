@@ -0,0 +1,453 @@
+# Offline load simulation for the session-generation flow.
+#
+# Drives the real handlers in main.py (start_command, callback_handler,
+# message_handler and everything behind them) for thousands of concurrent
+# simulated users. The Telegram side is an in-process fake: the bot's replies
+# and every MTProto call of the per-user login clients just sleep for a
+# configurable latency, and can be made to fail with FloodWait or other errors.
+# Updates go through a fixed pool of worker tasks like Pyrogram's dispatcher,
+# so a handler that holds its worker shows up as queueing for everyone else.
+#
+#   python loadtest.py --users 2000 --latency 50 --flood-rate 0.01
+#
+# Reports flow throughput, p50/p90/p99 latency per step and peak memory, so a
+# change can be compared against a baseline run with the same --seed.
+import os
+import time
+import json
+import random
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import tracemalloc
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load-simulate the session generation flow against a fake Telegram")
+    parser.add_argument("--users", type=int, default=1000, help="simulated users, each runs one full flow")
+    parser.add_argument("--ramp", type=float, default=5.0, help="seconds over which users arrive")
+    parser.add_argument("--latency", type=float, default=30.0, help="mean MTProto call latency (ms)")
+    parser.add_argument("--bot-latency", type=float, default=10.0, help="mean latency of the bot's own replies (ms)")
+    parser.add_argument("--jitter", type=float, default=0.5, help="latency varies uniformly by +/- this fraction")
+    parser.add_argument("--think", type=float, default=0.0, help="user pause between steps (ms)")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="chance an MTProto call raises FloodWait")
+    parser.add_argument("--flood-seconds", type=int, default=5)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="chance an MTProto call fails outright")
+    parser.add_argument("--password-rate", type=float, default=0.3, help="share of user accounts with 2FA")
+    parser.add_argument("--mix", default="pyrogram=4,telethon=4,pyrogram_bot=1,telethon_bot=1",
+                        help="library weights, as picked from the library buttons")
+    parser.add_argument("--login-limit", type=int, default=None, help="override LOGIN_CLIENT_LIMIT")
+    parser.add_argument("--workers", type=int, default=min(32, (os.cpu_count() or 0) + 4),
+                        help="dispatcher worker tasks, Pyrogram's default is min(32, cpu + 4)")
+    parser.add_argument("--max-queue-wait", type=float, default=0.5,
+                        help="fail the run if an update waited longer than this for a worker (s, p99)")
+    parser.add_argument("--step-timeout", type=float, default=30.0,
+                        help="give up on a user whose update no worker finished handling within this many seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tracemalloc", action="store_true", help="also report peak Python heap (slows the run)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's own logging")
+    return parser.parse_args()
+
+args = parse_args()
+
+# main.py reads its configuration at import time
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="loadtest-"), "users.db")
+os.environ["SESSION_BACKEND"] = "memory"
+os.environ["PREWARM_POOL_SIZE"] = "0"
+os.environ.pop("BOT_SESSION_DIR", None)
+if args.login_limit is not None:
+    os.environ["LOGIN_CLIENT_LIMIT"] = str(args.login_limit)
+
+import main
+from pyrogram.errors import FloodWait, SessionPasswordNeeded
+
+if not args.verbose:
+    logging.getLogger().setLevel(logging.WARNING)
+
+rng = random.Random(args.seed)
+
+def delay(mean_ms):
+    return max(0.0, mean_ms / 1000 * rng.uniform(1 - args.jitter, 1 + args.jitter))
+
+# Fake Telegram
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.username = f"user{user_id}"
+        self.first_name = "Load"
+        self.last_name = str(user_id)
+
+class FakeChat:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.replies = []
+        self.replied = asyncio.Event()
+
+    def add(self, text):
+        self.replies.append(text)
+        self.replied.set()
+
+    async def wait_for(self, accept, start=0):
+        # First reply from index `start` on that accept() takes
+        while True:
+            for text in self.replies[start:]:
+                if accept(text):
+                    return text
+            start = len(self.replies)
+            self.replied.clear()
+            await self.replied.wait()
+
+class FakeMessage:
+    def __init__(self, user, chat, text=""):
+        self.from_user = user
+        self.chat = chat
+        self.text = text
+        self.command = text[1:].split() if text.startswith("/") else None
+        self.reply_to_message = None
+
+    async def reply_text(self, text, **kwargs):
+        await asyncio.sleep(delay(args.bot_latency))
+        self.chat.add(text)
+        return FakeMessage(self.from_user, self.chat, text)
+
+    async def edit_text(self, text, **kwargs):
+        await asyncio.sleep(delay(args.bot_latency))
+        self.chat.add(text)
+        return self
+
+class FakeCallbackQuery:
+    def __init__(self, user, message, data):
+        self.from_user = user
+        self.message = message
+        self.data = data
+
+    async def answer(self, text=None, **kwargs):
+        await asyncio.sleep(delay(args.bot_latency))
+
+class FakeBot:
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(delay(args.bot_latency))
+
+class FakeSentCode:
+    def __init__(self):
+        self.phone_code_hash = f"{rng.getrandbits(64):016x}"
+
+class FakeSession:
+    def save(self):
+        return "1" + "A" * 352
+
+class FakeLoginClient:
+    # Answers both the Pyrogram and the Telethon calls main.py makes
+    live = 0
+    peak = 0
+
+    def __init__(self, library, has_password):
+        self.library = library
+        self.has_password = has_password
+        self.is_connected = False
+        self.password_checked = False
+        self.session = FakeSession()
+
+    async def rpc(self):
+        await asyncio.sleep(delay(args.latency))
+        roll = rng.random()
+        if roll < args.flood_rate:
+            raise FloodWait(value=args.flood_seconds)
+        if roll < args.flood_rate + args.error_rate:
+            raise ConnectionError("injected failure")
+
+    async def connect(self):
+        await self.rpc()
+        self.is_connected = True
+        FakeLoginClient.live += 1
+        FakeLoginClient.peak = max(FakeLoginClient.peak, FakeLoginClient.live)
+
+    async def disconnect(self):
+        if self.is_connected:
+            self.is_connected = False
+            FakeLoginClient.live -= 1
+
+    async def send_code(self, phone):
+        await self.rpc()
+        return FakeSentCode()
+
+    async def send_code_request(self, phone):
+        return await self.send_code(phone)
+
+    async def sign_in(self, *params, code=None, password=None, **kwargs):
+        await self.rpc()
+        if password is not None:
+            self.password_checked = True
+        elif self.has_password:
+            raise SessionPasswordNeeded()
+
+    async def check_password(self, password=None):
+        await self.rpc()
+        self.password_checked = True
+
+    async def sign_in_bot(self, token):
+        await self.rpc()
+
+    async def start(self, bot_token=None):
+        await self.rpc()
+
+    async def export_session_string(self):
+        await self.rpc()
+        return "B" * 351
+
+    async def send_message(self, chat_id, text):
+        await self.rpc()
+
+def install_fakes(accounts):
+    # Route main.py's client construction to the fake, keyed by api_id so
+    # each simulated user gets their own account behaviour
+    def pyrogram_client(name, api_id, api_hash, **kwargs):
+        library = "pyrogram_bot" if "bot_token" in kwargs else "pyrogram"
+        return FakeLoginClient(library, accounts[api_id])
+
+    async def telethon_client(session_string, api_id, api_hash):
+        return FakeLoginClient("telethon", accounts[api_id])
+
+    main.create_pyrogram_client = pyrogram_client
+    main.create_telethon_client = telethon_client
+    # Nothing to import, the fake stands in for Telethon
+    main.telethon_classes = {}
+
+class Dispatcher:
+    # Mirrors Pyrogram's dispatcher: one update queue drained by a fixed
+    # number of worker tasks, each running one handler to completion before
+    # taking the next update
+    def __init__(self, workers):
+        self.workers = workers
+        self.queue = asyncio.Queue()
+        self.tasks = []
+        self.waits = []
+        self.peak_backlog = 0
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+
+    async def work(self):
+        while True:
+            handler, client, update, done, queued = await self.queue.get()
+            self.waits.append(time.perf_counter() - queued)
+            try:
+                await handler(client, update)
+            except Exception as e:
+                # Pyrogram logs a failed handler and moves on
+                logging.getLogger("loadtest").error(f"Handler {handler.__name__} failed: {e}")
+            done.set_result(None)
+
+    async def dispatch(self, handler, client, update):
+        done = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((handler, client, update, done, time.perf_counter()))
+        self.peak_backlog = max(self.peak_backlog, self.queue.qsize())
+        await done
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+# Simulated users
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class Recorder:
+    def __init__(self):
+        self.steps = {}
+        self.flows = []
+        self.outcomes = {}
+
+    def step(self, name, seconds):
+        self.steps.setdefault(name, []).append(seconds)
+
+    def outcome(self, name, seconds):
+        self.outcomes[name] = self.outcomes.get(name, 0) + 1
+        if name == "generated":
+            self.flows.append(seconds)
+
+def pick_library(weights):
+    libraries = list(weights)
+    return rng.choices(libraries, [weights[library] for library in libraries])[0]
+
+class Stalled(Exception):
+    pass
+
+async def simulate_user(dispatcher, bot, recorder, user_id, library, arrival):
+    await asyncio.sleep(arrival)
+    user = FakeUser(user_id)
+    chat = FakeChat(user_id)
+    panel = FakeMessage(user, chat)
+    flow_started = time.perf_counter()
+
+    async def timed(name, handler, update, answered=None):
+        started = time.perf_counter()
+        seen = len(chat.replies)
+        try:
+            await asyncio.wait_for(dispatcher.dispatch(handler, bot, update), args.step_timeout)
+        except asyncio.TimeoutError:
+            raise Stalled(f"stalled: {name} not handled within {args.step_timeout:g}s")
+        if answered is not None:
+            # The login flow answers from its own task after the handler
+            # returned, bounded by its own step deadlines
+            await chat.wait_for(answered, seen)
+        recorder.step(name, time.perf_counter() - started)
+        if args.think:
+            await asyncio.sleep(delay(args.think))
+
+    async def send(name, text, answered=None):
+        await timed(name, main.message_handler, FakeMessage(user, chat, text), answered)
+
+    def login_answered(text):
+        return text.startswith("❌") or "OTP sent" in text or "Session generated successfully" in text
+
+    try:
+        await timed("start", main.start_command, FakeMessage(user, chat, "/start"))
+        await timed("generate", main.callback_handler, FakeCallbackQuery(user, panel, "generate"))
+        await timed("library", main.callback_handler, FakeCallbackQuery(user, panel, library))
+        await send("api_id", str(user_id))
+        await send("api_hash", "0123456789abcdef0123456789abcdef")
+        if "bot" in library:
+            await send("auth_data", f"{user_id}:AAbbCCddEEffGGhhIIjjKKllMMnnOOppQQ", login_answered)
+        else:
+            await send("auth_data", f"+1555{user_id:07d}", login_answered)
+            # The flow ends the session on any failure, further input is ignored
+            if await main.session_backend.get(user_id) is not None:
+                await send("otp", "1 2 3 4 5")
+            if await main.session_backend.get(user_id) is not None:
+                await send("password", "hunter2")
+    except Stalled as e:
+        recorder.outcome(str(e), time.perf_counter() - flow_started)
+        return
+
+    elapsed = time.perf_counter() - flow_started
+    if any("Session generated successfully" in reply for reply in chat.replies):
+        recorder.outcome("generated", elapsed)
+    else:
+        # First line of the last reply, which is the error message shown
+        reason = chat.replies[-1].splitlines()[0] if chat.replies else "no reply"
+        recorder.outcome(reason[:60], elapsed)
+
+async def run():
+    weights = {}
+    for part in args.mix.split(","):
+        library, _, weight = part.partition("=")
+        weights[library.strip()] = float(weight or 1)
+
+    user_ids = [10_000_000 + index for index in range(args.users)]
+    accounts = {user_id: rng.random() < args.password_rate for user_id in user_ids}
+    install_fakes(accounts)
+
+    main.registration_queue.start()
+    main.live_clients.start()
+    await main.session_backend.start()
+
+    bot = FakeBot()
+    recorder = Recorder()
+    dispatcher = Dispatcher(args.workers)
+    dispatcher.start()
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(
+            simulate_user(dispatcher, bot, recorder, user_id, pick_library(weights), rng.uniform(0, args.ramp))
+            for user_id in user_ids
+        ))
+    finally:
+        wall = time.perf_counter() - started
+        await dispatcher.stop()
+        await main.stop_logins()
+        await main.session_backend.stop()
+        await main.live_clients.stop()
+        await main.registration_queue.stop()
+    return recorder, dispatcher, wall
+
+def report(recorder, dispatcher, wall, heap_peak):
+    handled = sum(len(samples) for samples in recorder.steps.values())
+    result = {
+        "users": args.users,
+        "wall_seconds": round(wall, 3),
+        "flows_per_second": round(len(recorder.flows) / wall, 2) if wall else 0.0,
+        "updates_per_second": round(handled / wall, 2) if wall else 0.0,
+        "outcomes": recorder.outcomes,
+        "flow_latency": {
+            name: round(percentile(recorder.flows, fraction), 4)
+            for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))
+        },
+        "steps": {
+            name: {
+                "count": len(samples),
+                "p50": round(percentile(samples, 0.5), 4),
+                "p90": round(percentile(samples, 0.9), 4),
+                "p99": round(percentile(samples, 0.99), 4),
+                "max": round(max(samples), 4),
+            }
+            for name, samples in recorder.steps.items()
+        },
+        "dispatcher": {
+            "workers": dispatcher.workers,
+            "queue_wait_p50": round(percentile(dispatcher.waits, 0.5), 4),
+            "queue_wait_p99": round(percentile(dispatcher.waits, 0.99), 4),
+            "queue_wait_max": round(max(dispatcher.waits, default=0.0), 4),
+            "peak_backlog": dispatcher.peak_backlog,
+        },
+        "login_limit": main.LOGIN_CLIENT_LIMIT,
+        "peak_login_clients": FakeLoginClient.peak,
+        "leaked_login_clients": FakeLoginClient.live,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    if heap_peak is not None:
+        result["heap_peak_mb"] = round(heap_peak / 1024 / 1024, 1)
+    # Updates stuck behind busy workers mean handlers are holding them
+    stalled = sum(count for name, count in recorder.outcomes.items() if name.startswith("stalled"))
+    result["healthy"] = result["dispatcher"]["queue_wait_p99"] <= args.max_queue_wait and not stalled
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return result["healthy"]
+
+    print(f"{args.users} users in {result['wall_seconds']}s: "
+          f"{result['flows_per_second']} sessions/s, {result['updates_per_second']} updates/s")
+    print(f"Flow latency: p50 {result['flow_latency']['p50']}s, p90 {result['flow_latency']['p90']}s, "
+          f"p99 {result['flow_latency']['p99']}s")
+    print(f"{'step':<10} {'count':>7} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+    for name, stats in result["steps"].items():
+        print(f"{name:<10} {stats['count']:>7} {stats['p50']:>9.4f} {stats['p90']:>9.4f} "
+              f"{stats['p99']:>9.4f} {stats['max']:>9.4f}")
+    print("Outcomes:")
+    for name, count in sorted(recorder.outcomes.items(), key=lambda item: item[1], reverse=True):
+        print(f"  {count:>7}  {name}")
+    print(f"Login clients: peak {result['peak_login_clients']} of limit {result['login_limit']}, "
+          f"{result['leaked_login_clients']} left connected")
+    memory = f"Memory: max RSS {result['max_rss_mb']} MB"
+    if heap_peak is not None:
+        memory += f", Python heap peak {result['heap_peak_mb']} MB"
+    print(memory)
+    dispatch = result["dispatcher"]
+    print(f"Dispatcher: {dispatch['workers']} workers, queue wait p50 {dispatch['queue_wait_p50']}s, "
+          f"p99 {dispatch['queue_wait_p99']}s, max {dispatch['queue_wait_max']}s, "
+          f"peak backlog {dispatch['peak_backlog']} updates")
+    if stalled:
+        print(f"UNHEALTHY: {stalled} users stalled, no worker got to their updates in time")
+    elif not result["healthy"]:
+        print(f"UNHEALTHY: p99 queue wait above {args.max_queue_wait}s, handlers are holding dispatcher workers")
+    return result["healthy"]
+
+if __name__ == "__main__":
+    if args.tracemalloc:
+        tracemalloc.start()
+    main.user_store.open()
+    try:
+        recorder, dispatcher, wall = asyncio.run(run())
+    finally:
+        main.user_store.close()
+    heap_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+    if not report(recorder, dispatcher, wall, heap_peak):
+        raise SystemExit(1)
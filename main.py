@@ -1,18 +1,33 @@
+import time
+STARTUP_BEGAN = time.perf_counter()
+
 import os
 import logging
 import asyncio
 import sqlite3
-import time
-from pyrogram import Client, filters, idle
+import json
+import base64
+import struct
+import re
+import datetime
+import io
+import sys
+import threading
+import traceback
+import bisect
+import functools
+import socket
+from types import SimpleNamespace
+from collections import deque
+from collections import OrderedDict
+from pyrogram import Client, filters, idle, raw
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from pyrogram.errors import (
     ApiIdInvalid, PhoneNumberInvalid, PhoneCodeInvalid,
-    PhoneCodeExpired, SessionPasswordNeeded, PasswordHashInvalid
+    PhoneCodeExpired, SessionPasswordNeeded, PasswordHashInvalid, FloodWait,
+    MessageNotModified, UserIsBlocked, InputUserDeactivated, PeerIdInvalid, UserIdInvalid
 )
-from telethon import TelegramClient
-from telethon.sessions import StringSession
-from flask import Flask
-import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Configure logging
 logging.basicConfig(
@@ -21,36 +36,1575 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Startup timing report: import, DB init, app.start() and first handled
+# update, each in seconds
+startup_timings = {"imports": time.perf_counter() - STARTUP_BEGAN}
+
+def mark_startup(phase, started):
+    startup_timings[phase] = time.perf_counter() - started
+
+def startup_report():
+    return ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in startup_timings.items())
+
+# Metrics registry, rendered in the Prometheus text format on /metrics.
+# Recording is a dict lookup plus a few additions, cheap enough to leave on
+metrics_registry = []
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+        metrics_registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def label_text(self, key, extra=""):
+        pairs = [f'{label}="{value}"' for label, value in zip(self.labels, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield f"{self.name}{self.label_text(key)} {value}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self):
+        return sum(self.values.values())
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=(), read=None):
+        # `read` is polled at scrape time and returns a value, or a dict of
+        # label tuple -> value, for state that already lives elsewhere
+        super().__init__(name, help_text, labels)
+        self.read = read
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def samples(self):
+        if self.read is not None:
+            value = self.read()
+            self.values = value if isinstance(value, dict) else {(): value}
+        return super().samples()
+
+class Histogram(Metric):
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        series = self.values.get(key)
+        if series is None:
+            # Per-bucket counts (last one is +Inf), then sum and count
+            series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self):
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = self.label_text(key, f'le="{le}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            yield f"{self.name}_sum{self.label_text(key)} {total}"
+            yield f"{self.name}_count{self.label_text(key)} {count}"
+
+def render_metrics():
+    return "\n".join(metric.render() for metric in metrics_registry) + "\n"
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Time spent handling an update", ("handler", "kind"))
+SESSION_STAGE_SECONDS = Histogram("session_stage_seconds", "Time spent in each network step of session generation", ("stage",))
+SESSION_STAGE_TIMEOUTS = Counter("session_stage_timeouts_total", "Session generation steps that hit their deadline", ("stage",))
+DB_SECONDS = Histogram("db_call_seconds", "Time per database call, including the wait for the DB thread", ("op",))
+BROADCAST_SENDS = Counter("broadcast_sends_total", "Broadcast and promotion recipients by result "
+                          "(sent, blocked, deactivated, not_found, transient)", ("result",))
+BROADCAST_FAILURES = Counter("broadcast_failures_total", "Failed broadcast recipients by error", ("reason",))
+BROADCAST_FLOOD_WAITS = Counter("broadcast_flood_waits_total", "FloodWait errors hit while broadcasting")
+REGISTRATIONS = Counter("registrations_total", "/start registrations, queued for a write or skipped as unchanged", ("result",))
+LOGIN_WAIT_SECONDS = Histogram("login_queue_wait_seconds", "Time users waited for a login client slot")
+PREWARM_HITS = Counter("prewarm_hits_total", "Logins that took a pre-generated auth key")
+PREWARM_MISSES = Counter("prewarm_misses_total", "Logins that found no pre-generated auth key")
+SESSION_STORE_EXPIRED = Counter("session_store_expired_total",
+                                "In-memory session entries dropped after SESSION_TTL idle seconds", ("store",))
+SESSION_STORE_EVICTED = Counter("session_store_evicted_total", "In-memory session entries dropped past SESSION_MAX",
+                                ("store",))
+
+def timed_handler(name, kind=None):
+    # kind(*args) picks a sub-label, e.g. the callback query type
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(client, update):
+            started = time.perf_counter()
+            try:
+                return await func(client, update)
+            finally:
+                HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name,
+                                        kind=kind(update) if kind else "")
+        return wrapper
+    return decorator
+
 # Bot configuration
 API_ID = int(os.environ.get("API_ID", "0"))
 API_HASH = os.environ.get("API_HASH", "")
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
 OWNER_ID = 8385462088  # Your Telegram ID
 PORT = int(os.environ.get("PORT", 8080))
+DB_PATH = os.environ.get("DB_PATH", "users.db")
+BOT_SESSION_DIR = os.environ.get("BOT_SESSION_DIR", "")  # keep the bot's session on disk here, empty = in-memory
+UPDATE_STATE_INTERVAL = float(os.environ.get("UPDATE_STATE_INTERVAL", 10))
+HEALTH_LAG_LIMIT = float(os.environ.get("HEALTH_LAG_LIMIT", 1.0))  # seconds of loop lag before /health fails
+HEALTH_DB_TIMEOUT = float(os.environ.get("HEALTH_DB_TIMEOUT", 2.0))
+LOOP_WATCHDOG_INTERVAL = float(os.environ.get("LOOP_WATCHDOG_INTERVAL", 0.25))
+LOOP_STALL_THRESHOLD = float(os.environ.get("LOOP_STALL_THRESHOLD", 0.5))  # seconds blocked before the stack is captured
+LOOP_LAG_WINDOW = float(os.environ.get("LOOP_LAG_WINDOW", 10))  # seconds of lag history behind /health
+PROFILE_DEFAULT_SECONDS = float(os.environ.get("PROFILE_DEFAULT_SECONDS", 10))
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", 120))
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", 0.005))
+PROFILE_TOP = int(os.environ.get("PROFILE_TOP", 15))
+REGISTRATION_BATCH_SIZE = int(os.environ.get("REGISTRATION_BATCH_SIZE", 500))
+REGISTRATION_FLUSH_INTERVAL = float(os.environ.get("REGISTRATION_FLUSH_INTERVAL", 1.0))
+REGISTRATION_CACHE_SIZE = int(os.environ.get("REGISTRATION_CACHE_SIZE", 50000))  # users whose stored profile is remembered
+LAST_SEEN_INTERVAL = int(os.environ.get("LAST_SEEN_INTERVAL", 86400))  # seconds between last_seen writes per user
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 25))  # messages per second, shared by all jobs
+BROADCAST_BURST = int(os.environ.get("BROADCAST_BURST", 25))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", 10))
+BROADCAST_FLOOD_RETRIES = int(os.environ.get("BROADCAST_FLOOD_RETRIES", 5))
+BROADCAST_RECHECK_DAYS = int(os.environ.get("BROADCAST_RECHECK_DAYS", 0))  # retry blocked/not-found users after this many days, 0 = never
+USER_PAGE_SIZE = int(os.environ.get("USER_PAGE_SIZE", 1000))
+JOB_CHECKPOINT_EVERY = int(os.environ.get("JOB_CHECKPOINT_EVERY", 100))
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", 3.0))
+SESSION_TTL = float(os.environ.get("SESSION_TTL", 600))  # idle seconds before a conversation is dropped
+SESSION_MAX = int(os.environ.get("SESSION_MAX", 1000))
+SESSION_SWEEP_INTERVAL = float(os.environ.get("SESSION_SWEEP_INTERVAL", 30))
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "memory")  # "memory" or "sqlite" (shared by worker processes)
+WORKER_ID = os.environ.get("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+RELAY_DIR = os.environ.get("RELAY_DIR", os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "relay"))
+RELAY_TIMEOUT = float(os.environ.get("RELAY_TIMEOUT", 5))
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", 30))  # a dead job runner's jobs move on after this
+LOGIN_CLIENT_LIMIT = int(os.environ.get("LOGIN_CLIENT_LIMIT", 25))  # concurrent per-user MTProto clients
+PREWARM_POOL_SIZE = int(os.environ.get("PREWARM_POOL_SIZE", 2))  # spare auth keys per library, 0 disables
+PREWARM_MAX_AGE = float(os.environ.get("PREWARM_MAX_AGE", 3600))
+
+# Deadlines (seconds) for each network step of session generation
+STEP_TIMEOUTS = {
+    "connect": float(os.environ.get("TIMEOUT_CONNECT", 15)),
+    "send_code": float(os.environ.get("TIMEOUT_SEND_CODE", 20)),
+    "sign_in": float(os.environ.get("TIMEOUT_SIGN_IN", 20)),
+    "sign_in_bot": float(os.environ.get("TIMEOUT_SIGN_IN_BOT", 20)),
+    "check_password": float(os.environ.get("TIMEOUT_CHECK_PASSWORD", 20)),
+    "export_session": float(os.environ.get("TIMEOUT_EXPORT_SESSION", 15)),
+    "save_copy": float(os.environ.get("TIMEOUT_SAVE_COPY", 15)),
+    "disconnect": float(os.environ.get("TIMEOUT_DISCONNECT", 5)),
+}
+
+def client_connected(tg_client):
+    # Pyrogram exposes a flag, Telethon a method
+    connected = getattr(tg_client, "is_connected", False)
+    return connected() if callable(connected) else bool(connected)
+
+# Per-step deadlines: a hung DC turns into a fast StepTimeout instead of a
+# handler and a live client stuck forever
+class StepTimeout(Exception):
+    def __init__(self, step):
+        self.step = step
+        super().__init__(f"Telegram did not respond to {step} within {STEP_TIMEOUTS[step]:.0f}s")
+
+async def with_deadline(step, coro):
+    started = time.perf_counter()
+    try:
+        return await asyncio.wait_for(coro, STEP_TIMEOUTS[step])
+    except asyncio.TimeoutError:
+        SESSION_STAGE_TIMEOUTS.inc(stage=step)
+        logger.warning(f"Session generation step {step} timed out")
+        raise StepTimeout(step)
+    finally:
+        SESSION_STAGE_SECONDS.observe(time.perf_counter() - started, stage=step)
+
+async def close_client(tg_client):
+    try:
+        await with_deadline("disconnect", tg_client.disconnect())
+    except Exception as e:
+        logger.warning(f"Error disconnecting client: {e}")
+
+async def abort_connect(tg_client):
+    # A connect() cancelled halfway leaves Pyrogram's socket open without
+    # marking the client connected, so its disconnect() would refuse
+    try:
+        if isinstance(tg_client, Client):
+            if getattr(tg_client, "session", None) is not None:
+                await with_deadline("disconnect", tg_client.session.stop())
+        else:
+            await with_deadline("disconnect", tg_client.disconnect())
+    except Exception as e:
+        logger.warning(f"Error aborting connect: {e}")
+
+# User states for session generation. Entries expire after SESSION_TTL idle
+# seconds and the least recently used one is dropped past SESSION_MAX; a
+# dropped entry's tg_client is disconnected so its socket doesn't leak
+class SessionStore:
+    def __init__(self, name, ttl, max_size, sweep_interval, on_discard=None):
+        # `name` labels this store's metrics
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.sweep_interval = sweep_interval
+        self.entries = OrderedDict()  # user_id -> [expires_at, session_data]
+        self.expired = 0
+        self.evicted = 0
+        self.closing = set()
+        self.on_discard = on_discard
+        self.task = None
+
+    def __contains__(self, user_id):
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return False
+        if entry[0] <= time.monotonic():
+            self.expired += 1
+            SESSION_STORE_EXPIRED.inc(store=self.name)
+            self.discard(user_id)
+            return False
+        return True
+
+    def __getitem__(self, user_id):
+        if user_id not in self:
+            raise KeyError(user_id)
+        entry = self.entries[user_id]
+        entry[0] = time.monotonic() + self.ttl
+        self.entries.move_to_end(user_id)
+        return entry[1]
+
+    def __setitem__(self, user_id, session_data):
+        # Replacing an entry keeps the user, so on_discard doesn't fire
+        entry = self.entries.pop(user_id, None)
+        if entry is not None and entry[1].get("tg_client") is not session_data.get("tg_client"):
+            self.close(entry[1])
+        self.entries[user_id] = [time.monotonic() + self.ttl, session_data]
+        while len(self.entries) > self.max_size:
+            self.evicted += 1
+            SESSION_STORE_EVICTED.inc(store=self.name)
+            self.discard(next(iter(self.entries)))
+
+    def __delitem__(self, user_id):
+        if user_id not in self.entries:
+            raise KeyError(user_id)
+        self.discard(user_id)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def discard(self, user_id):
+        entry = self.entries.pop(user_id, None)
+        if entry is None:
+            return
+        if self.on_discard is not None:
+            self.on_discard(user_id)
+        self.close(entry[1])
+
+    def close(self, session_data):
+        tg_client = session_data.get("tg_client")
+        if tg_client is not None and client_connected(tg_client):
+            task = asyncio.get_running_loop().create_task(close_client(tg_client))
+            self.closing.add(task)
+            task.add_done_callback(self.closing.discard)
+
+    def sweep(self):
+        now = time.monotonic()
+        stale = [user_id for user_id, entry in self.entries.items() if entry[0] <= now]
+        for user_id in stale:
+            self.expired += 1
+            SESSION_STORE_EXPIRED.inc(store=self.name)
+            self.discard(user_id)
+        if stale:
+            logger.info(f"Dropped {len(stale)} idle sessions, {len(self.entries)} live")
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            self.sweep()
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        for user_id in list(self.entries):
+            self.discard(user_id)
+        await asyncio.gather(*self.closing, return_exceptions=True)
+
+    def metrics(self):
+        return {
+            "live": len(self.entries),
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+# Admission control for login clients: at most `limit` users hold a slot,
+# everyone else waits in arrival order
+class AdmissionCancelled(Exception):
+    pass
+
+class AdmissionController:
+    def __init__(self, limit):
+        self.limit = limit
+        self.holders = set()
+        self.waiters = OrderedDict()  # user_id -> future, in arrival order
+        self.admitted = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def position(self, user_id):
+        for position, waiting_id in enumerate(self.waiters, 1):
+            if waiting_id == user_id:
+                return position
+        return 0
+
+    async def acquire(self, user_id, on_queued=None):
+        if user_id in self.holders:
+            return
+        if len(self.holders) < self.limit and not self.waiters:
+            self.holders.add(user_id)
+            self.admitted += 1
+            return
+        
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[user_id] = future
+        started = time.monotonic()
+        try:
+            if on_queued is not None:
+                await on_queued(len(self.waiters))
+            await future
+        except asyncio.CancelledError:
+            # Give back the slot if it was granted while we were being cancelled
+            self.release(user_id)
+            raise
+        
+        waited = time.monotonic() - started
+        LOGIN_WAIT_SECONDS.observe(waited)
+        self.admitted += 1
+        self.wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def release(self, user_id):
+        future = self.waiters.pop(user_id, None)
+        if future is not None and not future.done():
+            future.set_exception(AdmissionCancelled())
+        if user_id not in self.holders:
+            return
+        self.holders.discard(user_id)
+        while self.waiters and len(self.holders) < self.limit:
+            next_id, future = self.waiters.popitem(last=False)
+            self.holders.add(next_id)
+            future.set_result(None)
+
+    def metrics(self):
+        return {
+            "active": len(self.holders),
+            "limit": self.limit,
+            "queued": len(self.waiters),
+            "admitted": self.admitted,
+            "avg_wait": self.wait_seconds / self.admitted if self.admitted else 0.0,
+            "max_wait": self.max_wait_seconds,
+        }
+
+login_admission = AdmissionController(LOGIN_CLIENT_LIMIT)
+
+# Connected MTProto clients only ever live in the process that created them;
+# dropping one gives its admission slot to the next user in the queue
+live_clients = SessionStore("live_clients", SESSION_TTL, SESSION_MAX, SESSION_SWEEP_INTERVAL, on_discard=login_admission.release)
+
+# Login flows past the auth_data step run as tasks of their own: waiting for a
+# slot must never hold one of the dispatcher's fixed pool of handler workers
+login_tasks = {}
+
+def start_login(user_id, coro):
+    task = asyncio.create_task(coro)
+    login_tasks[user_id] = task
+    task.add_done_callback(lambda done: login_tasks.pop(user_id, None) if login_tasks.get(user_id) is done else None)
+
+async def stop_logins():
+    for task in list(login_tasks.values()):
+        task.cancel()
+    await asyncio.gather(*login_tasks.values(), return_exceptions=True)
+
+# User store: one long-lived WAL connection owned by a dedicated worker
+# thread, so no SQLite call ever runs on the event loop
+class UserStore:
+    # Returning users keep their row and date_joined. The row is only
+    # rewritten if the profile changed, the user was marked unreachable (a
+    # /start means they are back) or last_seen is older than the interval
+    ADD_USER_SQL = """INSERT INTO users (user_id, username, first_name, last_name, last_seen)
+        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT (user_id) DO UPDATE SET
+            username = excluded.username, first_name = excluded.first_name,
+            last_name = excluded.last_name, last_seen = excluded.last_seen,
+            status_changed_at = CASE WHEN status != 'active' THEN CURRENT_TIMESTAMP ELSE status_changed_at END,
+            status = 'active'
+        WHERE username IS NOT excluded.username OR first_name IS NOT excluded.first_name
+            OR last_name IS NOT excluded.last_name OR status != 'active'
+            OR last_seen IS NULL OR last_seen < datetime('now', ?)"""
+    # Counters kept current by triggers on users, so stats never scan it
+    USER_COUNTS_SQL = "SELECT status, users FROM user_counts"
+    JOIN_DAYS_SQL = "SELECT day, users FROM join_days WHERE day >= date('now', ?) ORDER BY day"
+    # Reachable users: never failed permanently, or due for a re-check. A
+    # NULL cutoff (re-checks off) makes the second branch never match
+    REACHABLE_SQL = """(status = 'active' OR (status IN ('blocked', 'not_found')
+        AND status_changed_at < datetime('now', ?)))"""
+    NOT_RECIPIENT_SQL = """NOT EXISTS
+        (SELECT 1 FROM broadcast_recipients r WHERE r.job_id = ? AND r.user_id = users.user_id)"""
+    JOB_RESULT_COUNTS_SQL = "SELECT status, COUNT(*) FROM broadcast_recipients WHERE job_id = ? GROUP BY status"
+    STORED_RESULT_COUNTS_SQL = "SELECT result_counts FROM broadcast_jobs WHERE job_id = ?"
+    STORE_RESULT_COUNTS_SQL = "UPDATE broadcast_jobs SET result_counts = ? WHERE job_id = ?"
+    # Finished jobs still holding recipient rows: interrupted mid-purge, or
+    # finished before the counts were kept on the job
+    UNPURGED_JOBS_SQL = """SELECT job_id FROM broadcast_jobs WHERE status != 'running'
+        AND EXISTS (SELECT 1 FROM broadcast_recipients r WHERE r.job_id = broadcast_jobs.job_id)"""
+    PURGE_RECIPIENTS_SQL = """DELETE FROM broadcast_recipients WHERE job_id = ? AND user_id IN
+        (SELECT user_id FROM broadcast_recipients WHERE job_id = ? LIMIT ?)"""
+    CREATE_JOB_SQL = """INSERT INTO broadcast_jobs (kind, text, from_chat_id, message_id,
+        progress_chat_id, progress_message_id, total, segment, command_chat_id, command_message_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+    GET_JOB_SQL = "SELECT * FROM broadcast_jobs WHERE job_id = ?"
+    COMMAND_JOB_SQL = "SELECT job_id FROM broadcast_jobs WHERE command_chat_id = ? AND command_message_id = ?"
+    RUNNING_JOBS_SQL = "SELECT * FROM broadcast_jobs WHERE status = 'running' ORDER BY job_id"
+    ADD_RECIPIENTS_SQL = "INSERT OR REPLACE INTO broadcast_recipients (job_id, user_id, status) VALUES (?, ?, ?)"
+    CHECKPOINT_JOB_SQL = "UPDATE broadcast_jobs SET sent = ?, failed = ?, cursor = ?, status = ? WHERE job_id = ?"
+    # A lease is renewed by its owner, or taken over once it has run out
+    ACQUIRE_LEASE_SQL = """INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+        ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+        WHERE leases.owner = excluded.owner OR leases.expires_at <= ?"""
+    LEASE_OWNER_SQL = "SELECT owner FROM leases WHERE name = ?"
+    RELEASE_LEASE_SQL = "DELETE FROM leases WHERE name = ? AND owner = ?"
+    # Stamped on every permanent failure, not just a change of status, so a
+    # re-checked user who fails again waits out a full re-check window
+    SET_USER_STATUS_SQL = "UPDATE users SET status = ?, status_changed_at = CURRENT_TIMESTAMP WHERE user_id = ?"
+    UNREACHABLE_USERS_SQL = "SELECT user_id FROM users WHERE status != 'active' AND user_id IN ({})"
+    MARK_MESSAGED_SQL = """UPDATE users SET last_messaged = CURRENT_TIMESTAMP,
+        status_changed_at = CASE WHEN status != 'active' THEN CURRENT_TIMESTAMP ELSE status_changed_at END,
+        status = 'active' WHERE user_id = ?"""
+    RECORD_GENERATION_SQL = """INSERT INTO user_generations (library, user_id) VALUES (?, ?)
+        ON CONFLICT (library, user_id) DO UPDATE SET generated_at = CURRENT_TIMESTAMP"""
+    SET_JOB_PROGRESS_SQL = "UPDATE broadcast_jobs SET progress_message_id = ? WHERE job_id = ?"
+    GET_UPDATE_STATE_SQL = "SELECT pts, qts, date, seq FROM bot_update_state WHERE id = 0"
+    SAVE_UPDATE_STATE_SQL = "INSERT OR REPLACE INTO bot_update_state (id, pts, qts, date, seq) VALUES (0, ?, ?, ?, ?)"
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.executor = None
+        self.ping_conn = None
+        self.ping_executor = None
+
+    def open(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="userdb")
+        self.executor.submit(self._open).result()
+        # Health pings get their own connection and thread. A WAL reader
+        # never waits on the main connection, so a ping can't queue behind
+        # a long query there
+        self.ping_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="userdb-ping")
+        logger.info("Database initialized")
+
+    def close(self):
+        if self.ping_executor is not None:
+            self.ping_executor.submit(self._close_ping).result()
+            self.ping_executor.shutdown(wait=True)
+            self.ping_executor = None
+        if self.executor is not None:
+            self.executor.submit(self._close).result()
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started, op=func.__name__.lstrip("_"))
+
+    async def add_users(self, rows):
+        last_seen_cutoff = f"-{LAST_SEEN_INTERVAL} seconds"
+        await self.run(self._add_users, [row + (last_seen_cutoff,) for row in rows])
+
+    async def get_unreachable_users(self, user_ids):
+        # Which of these users are stored with a status other than 'active'
+        return await self.run(self._get_unreachable_users, list(user_ids))
+
+    async def iter_job_recipients(self, job_id, after_id, segment=None, page_size=USER_PAGE_SIZE):
+        # Users in the job's segment past its cursor that it has not already recorded
+        async for user_id in self._iter_pages(self._get_job_recipient_page, after_id, page_size, job_id, segment or {}):
+            yield user_id
+
+    async def _iter_pages(self, get_page, after_id, page_size, *args):
+        # Keyset pagination on the primary key: only one page is ever held
+        # in memory and each page is an index range scan, not an OFFSET
+        while True:
+            page = await self.run(get_page, after_id, page_size, *args)
+            for user_id in page:
+                yield user_id
+            if len(page) < page_size:
+                return
+            after_id = page[-1]
+
+    async def count_audience(self, segment=None):
+        cutoff = recheck_cutoff()
+        if cutoff is None and not segment:
+            return (await self.get_user_counts()).get("active", 0)
+        # Re-checks depend on how long ago users failed and segments on
+        # per-user columns, which no counter knows
+        sql, params = self._audience_query(segment, cutoff, "COUNT(*)")
+        row = await self.fetchone(sql, params)
+        return row[0]
+
+    async def record_generation(self, user_id, library):
+        await self.execute(self.RECORD_GENERATION_SQL, (library, user_id))
+
+    async def get_user_counts(self):
+        return await self.run(self._get_user_counts)
+
+    async def get_join_days(self, days):
+        # New users per UTC day over the last `days` days, oldest first
+        return await self.run(self._get_join_days, days)
+
+    async def get_job_result_counts(self, job_id):
+        return await self.run(self._get_job_result_counts, job_id)
+
+    async def create_job(self, kind, text, from_chat_id, message_id, progress_chat_id, progress_message_id, total,
+                         segment=None, command=(None, None)):
+        return await self.run(self._create_job, kind, text, from_chat_id, message_id,
+                              progress_chat_id, progress_message_id, total, segment, command)
+
+    async def get_command_job(self, chat_id, message_id):
+        row = await self.fetchone(self.COMMAND_JOB_SQL, (chat_id, message_id))
+        return row[0] if row else None
+
+    async def get_running_jobs(self):
+        return await self.run(self._get_running_jobs)
+
+    async def acquire_lease(self, name, owner, seconds):
+        return await self.run(self._acquire_lease, name, owner, seconds)
+
+    async def release_lease(self, name, owner):
+        await self.run(self._execute, self.RELEASE_LEASE_SQL, (name, owner))
+
+    async def checkpoint_job(self, job_id, results, sent, failed, cursor, status="running"):
+        await self.run(self._checkpoint_job, job_id, results, sent, failed, cursor, status)
+
+    async def purge_job_recipients(self, job_id, page_size=USER_PAGE_SIZE):
+        # A page per transaction, so other queries get the connection in between
+        while await self.run(self._purge_recipient_page, job_id, page_size):
+            pass
+
+    async def purge_finished_jobs(self):
+        for job_id in await self.run(self._get_unpurged_jobs):
+            await self.purge_job_recipients(job_id)
+
+    async def execute(self, sql, params):
+        await self.run(self._execute, sql, params)
+
+    async def fetchone(self, sql, params):
+        return await self.run(self._fetchone, sql, params)
+
+    async def fetchall(self, sql, params):
+        return await self.run(self._fetchall, sql, params)
+
+    async def ping(self):
+        # Whether the file answers a read, however busy the main connection is
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.ping_executor, self._ping)
+
+    async def set_job_progress_message(self, job_id, message_id):
+        await self.run(self._execute, self.SET_JOB_PROGRESS_SQL, (message_id, job_id))
+
+    async def get_update_state(self):
+        row = await self.fetchone(self.GET_UPDATE_STATE_SQL, ())
+        return dict(row) if row else None
+
+    async def save_update_state(self, state):
+        await self.execute(self.SAVE_UPDATE_STATE_SQL, (state["pts"], state["qts"], state["date"], state["seq"]))
+
+    # Everything below runs on the worker thread only
+    def _open(self):
+        # sqlite3 keeps compiled statements in a per-connection cache, so
+        # reusing the same SQL strings on one connection avoids re-preparing
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=64)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.row_factory = sqlite3.Row
+        self._migrate()
+
+    # Schema migrations, applied in order; PRAGMA user_version holds how many
+    # have run. Only ever append: a released step must not change
+    def _migrations(self):
+        return [self._migrate_baseline, self._migrate_user_stats, self._migrate_indexes, self._migrate_segments,
+                self._migrate_leases, self._migrate_job_commands, self._migrate_job_results]
+
+    def _migrate(self):
+        migrations = self._migrations()
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version > len(migrations):
+            logger.warning(f"Database schema version {version} is newer than this code ({len(migrations)})")
+            return
+        for number, migration in enumerate(migrations[version:], start=version + 1):
+            started = time.perf_counter()
+            # Each step and its version bump commit together, so a crash
+            # mid-migration leaves the database at the previous version
+            self.conn.execute("BEGIN")
+            try:
+                migration()
+                self.conn.execute(f"PRAGMA user_version = {number}")
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            logger.info(f"Database migrated to version {number} ({migration.__name__[9:]}) "
+                        f"in {time.perf_counter() - started:.2f}s")
+
+    def _migrate_baseline(self):
+        # Everything created before versioning. Databases from that time can be
+        # at any point of it, so each piece is only added if missing
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS users
+                     (user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, last_name TEXT, 
+                      date_joined TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        # Delivery status: 'active', or the permanent failure of the last send
+        columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(users)")}
+        if "status" not in columns:
+            self.conn.execute("ALTER TABLE users ADD COLUMN status TEXT NOT NULL DEFAULT 'active'")
+        if "status_changed_at" not in columns:
+            self.conn.execute("ALTER TABLE users ADD COLUMN status_changed_at TIMESTAMP")
+        if "last_seen" not in columns:
+            self.conn.execute("ALTER TABLE users ADD COLUMN last_seen TIMESTAMP")
+        # A job's cursor means every user_id <= cursor has been handled;
+        # recipients beyond it that already got a result are listed separately
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS broadcast_jobs
+                     (job_id INTEGER PRIMARY KEY, kind TEXT NOT NULL, text TEXT,
+                      from_chat_id INTEGER, message_id INTEGER,
+                      progress_chat_id INTEGER, progress_message_id INTEGER,
+                      cursor INTEGER NOT NULL DEFAULT (-9223372036854775808),
+                      total INTEGER NOT NULL DEFAULT 0, sent INTEGER NOT NULL DEFAULT 0,
+                      failed INTEGER NOT NULL DEFAULT 0, status TEXT NOT NULL DEFAULT 'running',
+                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS broadcast_recipients
+                     (job_id INTEGER NOT NULL, user_id INTEGER NOT NULL, status TEXT NOT NULL,
+                      PRIMARY KEY (job_id, user_id)) WITHOUT ROWID''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS bot_update_state
+                     (id INTEGER PRIMARY KEY CHECK (id = 0), pts INTEGER NOT NULL, qts INTEGER NOT NULL,
+                      date INTEGER NOT NULL, seq INTEGER NOT NULL)''')
+        # Conversation state for SESSION_BACKEND=sqlite
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS session_states
+                     (user_id INTEGER PRIMARY KEY, state TEXT NOT NULL, expires_at REAL NOT NULL)''')
+
+    def _migrate_user_stats(self):
+        # Counts per delivery status and new users per day, seeded from the
+        # table once and then maintained by triggers in the writing transaction
+        exists = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_counts'"
+        ).fetchone()
+        if exists:
+            return
+        self.conn.execute("CREATE TABLE user_counts (status TEXT PRIMARY KEY, users INTEGER NOT NULL)")
+        self.conn.execute("CREATE TABLE join_days (day TEXT PRIMARY KEY, users INTEGER NOT NULL)")
+        self.conn.execute("INSERT INTO user_counts SELECT status, COUNT(*) FROM users GROUP BY status")
+        self.conn.execute("INSERT INTO join_days SELECT date(date_joined), COUNT(*) FROM users GROUP BY 1")
+        self.conn.execute('''CREATE TRIGGER users_stats_insert AFTER INSERT ON users BEGIN
+            INSERT INTO user_counts VALUES (new.status, 1)
+                ON CONFLICT (status) DO UPDATE SET users = users + 1;
+            INSERT INTO join_days VALUES (date(new.date_joined), 1)
+                ON CONFLICT (day) DO UPDATE SET users = users + 1;
+        END''')
+        self.conn.execute('''CREATE TRIGGER users_stats_delete AFTER DELETE ON users BEGIN
+            UPDATE user_counts SET users = users - 1 WHERE status = old.status;
+            UPDATE join_days SET users = users - 1 WHERE day = date(old.date_joined);
+        END''')
+        self.conn.execute('''CREATE TRIGGER users_stats_status AFTER UPDATE OF status ON users
+            WHEN old.status != new.status BEGIN
+            UPDATE user_counts SET users = users - 1 WHERE status = old.status;
+            INSERT INTO user_counts VALUES (new.status, 1)
+                ON CONFLICT (status) DO UPDATE SET users = users + 1;
+        END''')
+        self.conn.execute('''CREATE TRIGGER users_stats_joined AFTER UPDATE OF date_joined ON users
+            WHEN date(old.date_joined) IS NOT date(new.date_joined) BEGIN
+            UPDATE join_days SET users = users - 1 WHERE day = date(old.date_joined);
+            INSERT INTO join_days VALUES (date(new.date_joined), 1)
+                ON CONFLICT (day) DO UPDATE SET users = users + 1;
+        END''')
+
+    def _migrate_indexes(self):
+        # user_id is the rowid, so users is already clustered on it and the
+        # keyset scans need no index of their own. Audience pages walk
+        # (status, user_id) and skip unreachable users without touching rows
+        self.conn.execute("CREATE INDEX IF NOT EXISTS users_date_joined ON users (date_joined)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS users_status ON users (status, user_id)")
+        self.conn.execute("ANALYZE")
+
+    def _migrate_segments(self):
+        # What audience segments filter on. Generations are keyed by library
+        # first, so a library segment is a range in user_id order
+        self.conn.execute("ALTER TABLE users ADD COLUMN last_messaged TIMESTAMP")
+        self.conn.execute("ALTER TABLE broadcast_jobs ADD COLUMN segment TEXT")
+        self.conn.execute('''CREATE TABLE user_generations
+                     (library TEXT NOT NULL, user_id INTEGER NOT NULL,
+                      generated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                      PRIMARY KEY (library, user_id)) WITHOUT ROWID''')
+        self.conn.execute("CREATE INDEX users_last_seen ON users (last_seen)")
+
+    def _migrate_leases(self):
+        # Named leases let one of several workers sharing the file own a duty
+        self.conn.execute('''CREATE TABLE leases
+                     (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)''')
+
+    def _migrate_job_commands(self):
+        # The owner command that started a job, at most one job each. Older
+        # jobs have NULLs there, which never collide
+        self.conn.execute("ALTER TABLE broadcast_jobs ADD COLUMN command_chat_id INTEGER")
+        self.conn.execute("ALTER TABLE broadcast_jobs ADD COLUMN command_message_id INTEGER")
+        self.conn.execute('''CREATE UNIQUE INDEX broadcast_jobs_command
+                     ON broadcast_jobs (command_chat_id, command_message_id)''')
+
+    def _migrate_job_results(self):
+        # Per-class result counts (JSON) of a finished job, whose recipient
+        # rows are dropped once it no longer needs them to resume
+        self.conn.execute("ALTER TABLE broadcast_jobs ADD COLUMN result_counts TEXT")
+
+    def _close(self):
+        if self.conn is not None:
+            # Refreshes planner statistics if enough has changed since
+            self.conn.execute("PRAGMA optimize")
+            self.conn.close()
+            self.conn = None
+
+    # These two run on the ping thread
+    def _ping(self):
+        if self.ping_conn is None:
+            self.ping_conn = sqlite3.connect(self.path)
+        self.ping_conn.execute("SELECT COUNT(*) FROM user_counts").fetchone()
+
+    def _close_ping(self):
+        if self.ping_conn is not None:
+            self.ping_conn.close()
+            self.ping_conn = None
+
+    def _add_users(self, rows):
+        # One transaction (and one fsync) for the whole batch. Errors reach
+        # the caller, which still holds the rows
+        with self.conn:
+            self.conn.executemany(self.ADD_USER_SQL, rows)
+
+    def _get_unreachable_users(self, user_ids):
+        # Primary key lookups, chunked to stay under SQLite's variable limit
+        unreachable = []
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            sql = self.UNREACHABLE_USERS_SQL.format(", ".join("?" * len(chunk)))
+            unreachable.extend(row[0] for row in self.conn.execute(sql, chunk))
+        return unreachable
+
+    def _audience_query(self, segment, cutoff, columns, after_id=None, job_id=None, limit=None):
+        # Builds the audience SQL for a segment. Pages always walk user_id
+        # order, which job cursors rely on: a date segment walks the job's
+        # segment table, filled from a date index; a library segment walks
+        # its generations range; otherwise, with re-checks off, the (status,
+        # user_id) index. With re-checks on, NOT INDEXED keeps it a rowid
+        # walk, since an OR over the status index would sort every later
+        # user on each page. Counts keep no order and read the date index
+        # itself. Status, library (with dates) and quiet= are checked on the
+        # rows visited
+        segment = segment or {}
+        date_index = self._date_index(segment)
+        key = "users.user_id"
+        clauses, params = [], []
+        if date_index is not None and job_id is not None:
+            # CROSS JOIN keeps the segment table as the outer loop
+            source = f"temp.segment_{job_id} s CROSS JOIN users ON users.user_id = s.user_id"
+            key = "s.user_id"
+        elif date_index is not None:
+            source = f"users INDEXED BY {date_index}"
+            clauses, params = self._date_clauses(segment)
+        else:
+            source = "users NOT INDEXED" if cutoff is not None else "users"
+        if "library" in segment and date_index is not None:
+            clauses.append("EXISTS (SELECT 1 FROM user_generations g WHERE g.library = ? AND g.user_id = users.user_id)")
+            params.append(segment["library"])
+        elif "library" in segment:
+            source = f"user_generations g JOIN {source} ON users.user_id = g.user_id"
+            key = "g.user_id"
+            clauses.append("g.library = ?")
+            params.append(segment["library"])
+        if after_id is not None:
+            clauses.append(f"{key} > ?")
+            params.append(after_id)
+        if cutoff is None:
+            clauses.append("users.status = 'active'")
+        else:
+            clauses.append(self.REACHABLE_SQL)
+            params.append(cutoff)
+        if "quiet_days" in segment:
+            clauses.append("(users.last_messaged IS NULL OR users.last_messaged < datetime('now', ?))")
+            params.append(f"-{segment['quiet_days']} days")
+        if job_id is not None:
+            clauses.append(self.NOT_RECIPIENT_SQL)
+            params.append(job_id)
+        sql = f"SELECT {columns} FROM {source} WHERE {' AND '.join(clauses)}"
+        if limit is not None:
+            sql += f" ORDER BY {key} LIMIT ?"
+            params.append(limit)
+        return sql, params
+
+    @staticmethod
+    def _date_index(segment):
+        # The index a date segment is read through; a joined= range is
+        # usually the narrower one when both are given
+        if "joined_from" in segment or "joined_to" in segment:
+            return "users_date_joined"
+        if "seen_days" in segment:
+            return "users_last_seen"
+        return None
+
+    @staticmethod
+    def _date_clauses(segment):
+        clauses, params = [], []
+        if "joined_from" in segment:
+            clauses.append("users.date_joined >= ?")
+            params.append(segment["joined_from"])
+        if "joined_to" in segment:
+            clauses.append("users.date_joined < date(?, '+1 day')")
+            params.append(segment["joined_to"])
+        if "seen_days" in segment:
+            clauses.append("users.last_seen >= datetime('now', ?)")
+            params.append(f"-{segment['seen_days']} days")
+        return clauses, params
+
+    def _fill_segment_table(self, job_id, segment):
+        # A job's date-matched user ids, read once through the date index
+        # into a temp table that its pages then walk in user_id order.
+        # Rebuilt on a resume; the cursor and recorded results still apply
+        table = f"segment_{job_id}"
+        if self.conn.execute("SELECT 1 FROM sqlite_temp_master WHERE name = ?", (table,)).fetchone():
+            return
+        clauses, params = self._date_clauses(segment)
+        with self.conn:
+            self.conn.execute(f"CREATE TEMP TABLE {table} (user_id INTEGER PRIMARY KEY)")
+            self.conn.execute(f"INSERT INTO temp.{table} SELECT user_id FROM users INDEXED BY "
+                              f"{self._date_index(segment)} WHERE {' AND '.join(clauses)}", params)
+
+    def _get_job_recipient_page(self, after_id, limit, job_id, segment):
+        if self._date_index(segment) is not None:
+            self._fill_segment_table(job_id, segment)
+        sql, params = self._audience_query(segment, recheck_cutoff(), "users.user_id", after_id, job_id, limit)
+        return [row[0] for row in self.conn.execute(sql, params)]
+
+    def _get_job_result_counts(self, job_id):
+        row = self.conn.execute(self.STORED_RESULT_COUNTS_SQL, (job_id,)).fetchone()
+        if row is not None and row[0] is not None:
+            return json.loads(row[0])
+        return dict(self.conn.execute(self.JOB_RESULT_COUNTS_SQL, (job_id,)).fetchall())
 
-# User states for session generation
-user_sessions = {}
-
-# Initialize database
-def init_db():
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, last_name TEXT, 
-                  date_joined TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    conn.commit()
-    conn.close()
-    logger.info("Database initialized")
-
-# Initialize Pyrogram client
+    def _store_result_counts(self, job_id):
+        counts = dict(self.conn.execute(self.JOB_RESULT_COUNTS_SQL, (job_id,)).fetchall())
+        self.conn.execute(self.STORE_RESULT_COUNTS_SQL, (json.dumps(counts), job_id))
+
+    def _get_unpurged_jobs(self):
+        with self.conn:
+            job_ids = [row[0] for row in self.conn.execute(self.UNPURGED_JOBS_SQL).fetchall()]
+            for job_id in job_ids:
+                if self.conn.execute(self.STORED_RESULT_COUNTS_SQL, (job_id,)).fetchone()[0] is None:
+                    self._store_result_counts(job_id)
+        return job_ids
+
+    def _purge_recipient_page(self, job_id, page_size):
+        with self.conn:
+            return self.conn.execute(self.PURGE_RECIPIENTS_SQL, (job_id, job_id, page_size)).rowcount
+
+    def _get_user_counts(self):
+        return dict(self.conn.execute(self.USER_COUNTS_SQL).fetchall())
+
+    def _get_join_days(self, days):
+        return dict(self.conn.execute(self.JOIN_DAYS_SQL, (f"-{days - 1} days",)).fetchall())
+
+    def _execute(self, sql, params):
+        with self.conn:
+            self.conn.execute(sql, params)
+
+    def _fetchone(self, sql, params):
+        return self.conn.execute(sql, params).fetchone()
+
+    def _fetchall(self, sql, params):
+        return self.conn.execute(sql, params).fetchall()
+
+    def _create_job(self, kind, text, from_chat_id, message_id, progress_chat_id, progress_message_id, total, segment,
+                    command):
+        # The segment is stored with the job so a resume sends to the same audience
+        segment = json.dumps(segment) if segment else None
+        with self.conn:
+            job_id = self.conn.execute(self.CREATE_JOB_SQL, (kind, text, from_chat_id, message_id,
+                                                             progress_chat_id, progress_message_id, total,
+                                                             segment, *command)).lastrowid
+        return dict(self.conn.execute(self.GET_JOB_SQL, (job_id,)).fetchone())
+
+    def _get_running_jobs(self):
+        return [dict(row) for row in self.conn.execute(self.RUNNING_JOBS_SQL)]
+
+    def _acquire_lease(self, name, owner, seconds):
+        # Wall-clock expiry, since every process sharing the file must agree
+        now = time.time()
+        with self.conn:
+            self.conn.execute(self.ACQUIRE_LEASE_SQL, (name, owner, now + seconds, now))
+            return self.conn.execute(self.LEASE_OWNER_SQL, (name,)).fetchone()[0] == owner
+
+    def _checkpoint_job(self, job_id, results, sent, failed, cursor, status):
+        # Recipient results and counters land in the same transaction, so a
+        # crash can never count a send the resume would then repeat
+        # Permanent failures mark the user unreachable. A delivery stamps
+        # last_messaged and marks a re-checked user active again; transient
+        # failures change nothing
+        statuses = [(result, user_id) for user_id, result in results if result not in ("sent", "transient")]
+        messaged = [(user_id,) for user_id, result in results if result == "sent"]
+        with self.conn:
+            self.conn.executemany(self.ADD_RECIPIENTS_SQL, [(job_id, user_id, result) for user_id, result in results])
+            self.conn.executemany(self.SET_USER_STATUS_SQL, statuses)
+            self.conn.executemany(self.MARK_MESSAGED_SQL, messaged)
+            self.conn.execute(self.CHECKPOINT_JOB_SQL, (sent, failed, cursor, status, job_id))
+            if status != "running":
+                # Finished: the counts outlive the recipient rows, which
+                # purge_job_recipients drops next
+                self._store_result_counts(job_id)
+                self.conn.execute(f"DROP TABLE IF EXISTS temp.segment_{job_id}")
+
+def recheck_cutoff():
+    # SQLite datetime() modifier for the re-check window, None when disabled
+    return f"-{BROADCAST_RECHECK_DAYS} days" if BROADCAST_RECHECK_DAYS > 0 else None
+
+user_store = UserStore(DB_PATH)
+
+# Conversation state (step, library, api_id, ...) sits behind a backend so
+# it can be shared between worker processes; live clients stay in
+# live_clients and are re-attached as "tg_client" by the process owning them
+SESSION_STATE_KEYS = ("library", "step", "api_id", "worker")
+# The user's API hash, phone number or bot token and the code hash are never
+# handed to a backend, they stay in the memory of the worker running the flow
+PRIVATE_STATE_KEYS = ("api_hash", "auth_data", "phone_code_hash")
+
+def session_state(session_data):
+    return {key: session_data[key] for key in SESSION_STATE_KEYS if key in session_data}
+
+def private_state(session_data):
+    return {key: session_data[key] for key in PRIVATE_STATE_KEYS if key in session_data}
+
+class SessionBackend:
+    async def get(self, user_id):
+        raise NotImplementedError
+
+    async def set(self, user_id, session_data):
+        raise NotImplementedError
+
+    async def delete(self, user_id):
+        raise NotImplementedError
+
+    async def count(self):
+        raise NotImplementedError
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+class MemorySessionBackend(SessionBackend):
+    def __init__(self, ttl, max_size, sweep_interval):
+        # A conversation that expires while queued must leave the queue too
+        self.store = SessionStore("session_states", ttl, max_size, sweep_interval, on_discard=login_admission.release)
+
+    async def get(self, user_id):
+        if user_id not in self.store:
+            return None
+        return dict(self.store[user_id])
+
+    async def set(self, user_id, session_data):
+        self.store[user_id] = session_state(session_data)
+
+    async def delete(self, user_id):
+        self.store.discard(user_id)
+
+    async def count(self):
+        return len(self.store)
+
+    async def start(self):
+        self.store.start()
+
+    async def stop(self):
+        await self.store.stop()
+
+class SQLiteSessionBackend(SessionBackend):
+    GET_SQL = "SELECT state FROM session_states WHERE user_id = ? AND expires_at > ?"
+    SET_SQL = "INSERT OR REPLACE INTO session_states (user_id, state, expires_at) VALUES (?, ?, ?)"
+    DELETE_SQL = "DELETE FROM session_states WHERE user_id = ?"
+    COUNT_SQL = "SELECT COUNT(*) FROM session_states WHERE expires_at > ?"
+    EXPIRED_SQL = "SELECT user_id FROM session_states WHERE expires_at <= ?"
+    SWEEP_SQL = "DELETE FROM session_states WHERE expires_at <= ?"
+
+    def __init__(self, store, ttl, sweep_interval):
+        self.store = store
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.task = None
+
+    async def get(self, user_id):
+        row = await self.store.fetchone(self.GET_SQL, (user_id, time.time()))
+        return json.loads(row[0]) if row else None
+
+    async def set(self, user_id, session_data):
+        # Wall-clock expiry, since every process sharing the table must agree
+        state = json.dumps(session_state(session_data))
+        await self.store.execute(self.SET_SQL, (user_id, state, time.time() + self.ttl))
+
+    async def delete(self, user_id):
+        await self.store.execute(self.DELETE_SQL, (user_id,))
+
+    async def count(self):
+        return (await self.store.fetchone(self.COUNT_SQL, (time.time(),)))[0]
+
+    async def start(self):
+        # The session_states table comes with the user store's migrations
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                now = time.time()
+                expired = await self.store.fetchall(self.EXPIRED_SQL, (now,))
+                await self.store.execute(self.SWEEP_SQL, (now,))
+            except Exception as e:
+                logger.warning(f"Session sweep failed: {e}")
+                continue
+            # Expired users still queued in this process give up their place
+            for (user_id,) in expired:
+                login_admission.release(user_id)
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+def create_session_backend():
+    if SESSION_BACKEND == "sqlite":
+        return SQLiteSessionBackend(user_store, SESSION_TTL, SESSION_SWEEP_INTERVAL)
+    return MemorySessionBackend(SESSION_TTL, SESSION_MAX, SESSION_SWEEP_INTERVAL)
+
+session_backend = create_session_backend()
+
+# Secrets of the flows this worker runs, next to their login clients
+private_sessions = SessionStore("private_sessions", SESSION_TTL, SESSION_MAX, SESSION_SWEEP_INTERVAL)
+
+# Worker affinity for the sqlite backend: a flow belongs to the worker that
+# took its library choice, since only that one holds its secrets and client.
+# Input reaching any other worker is handed over through a Unix socket in
+# RELAY_DIR, so it never passes through users.db
+class RelayedMessage:
+    def __init__(self, client, user_id, chat_id, text):
+        self.client = client
+        self.from_user = SimpleNamespace(id=user_id)
+        self.chat = SimpleNamespace(id=chat_id)
+        self.text = text
+
+    async def reply_text(self, text, **kwargs):
+        return await self.client.send_message(self.chat.id, text, **kwargs)
+
+class SessionRelay:
+    def __init__(self, directory, worker_id):
+        self.directory = directory
+        self.worker_id = worker_id
+        self.client = None
+        self.server = None
+        self.tasks = set()
+
+    def socket_path(self, worker_id):
+        return os.path.join(self.directory, f"{worker_id}.sock")
+
+    async def start(self, client):
+        self.client = client
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        path = self.socket_path(self.worker_id)
+        # Left behind by an earlier process that had the same WORKER_ID
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = await asyncio.start_unix_server(self.handle, path)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+            os.unlink(self.socket_path(self.worker_id))
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def forward(self, worker_id, op, user_id, chat_id=None, text=None):
+        # True once the owning worker has accepted the input
+        request = {"op": op, "user_id": user_id, "chat_id": chat_id, "text": text}
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_unix_connection(self.socket_path(worker_id)), RELAY_TIMEOUT
+            )
+            try:
+                writer.write(json.dumps(request).encode() + b"\n")
+                return await asyncio.wait_for(reader.readline(), RELAY_TIMEOUT) == b"ok\n"
+            finally:
+                writer.close()
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.warning(f"Could not hand {op} for {user_id} to worker {worker_id}: {e}")
+            return False
+
+    async def handle(self, reader, writer):
+        try:
+            request = json.loads(await asyncio.wait_for(reader.readline(), RELAY_TIMEOUT))
+            writer.write(b"ok\n")
+            await writer.drain()
+        except Exception as e:
+            logger.warning(f"Bad relay request: {e}")
+            return
+        finally:
+            writer.close()
+        task = asyncio.create_task(self.dispatch(request))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def dispatch(self, request):
+        user_id = request["user_id"]
+        if request["op"] == "end":
+            await end_session(user_id)
+        else:
+            message = RelayedMessage(self.client, user_id, request["chat_id"], request["text"])
+            await message_handler(self.client, message)
+
+session_relay = SessionRelay(RELAY_DIR, WORKER_ID)
+
+async def load_session(user_id):
+    session_data = await session_backend.get(user_id)
+    if session_data is None:
+        return None
+    if user_id in private_sessions:
+        session_data.update(private_sessions[user_id])
+    if user_id in live_clients:
+        session_data["tg_client"] = live_clients[user_id]["tg_client"]
+    return session_data
+
+async def save_session(user_id, session_data):
+    session_data.setdefault("worker", WORKER_ID)
+    secrets = private_state(session_data)
+    if secrets:
+        private_sessions[user_id] = secrets
+    await session_backend.set(user_id, session_data)
+
+async def end_session(user_id):
+    session_data = await session_backend.get(user_id)
+    await session_backend.delete(user_id)
+    owner = session_data.get("worker", WORKER_ID) if session_data else WORKER_ID
+    if owner != WORKER_ID:
+        await session_relay.forward(owner, "end", user_id)
+    private_sessions.discard(user_id)
+    # Stop a flow still queued or connecting, unless it is the one ending itself
+    task = login_tasks.pop(user_id, None)
+    if task is not None and task is not asyncio.current_task():
+        task.cancel()
+    live_clients.discard(user_id)
+    login_admission.release(user_id)
+
+# Bot identity: filled from the get_me() done at startup, refreshed on demand
+class BotProfile:
+    def __init__(self):
+        self.me = None
+
+    def set(self, me):
+        self.me = me
+
+    async def get(self, client, refresh=False):
+        if self.me is None or refresh:
+            self.me = await client.get_me()
+        return self.me
+
+bot_profile = BotProfile()
+
+# Library adapters: Telethon is only imported the first time it's needed,
+# on a worker thread, so it stays off the cold-start path and the loop
+telethon_classes = None
+
+def import_telethon():
+    global telethon_classes
+    if telethon_classes is None:
+        started = time.perf_counter()
+        from telethon import TelegramClient
+        from telethon.sessions import StringSession
+        telethon_classes = (TelegramClient, StringSession)
+        logger.info(f"Telethon loaded in {time.perf_counter() - started:.2f}s")
+    return telethon_classes
+
+async def create_telethon_client(session_string, api_id, api_hash):
+    if telethon_classes is None:
+        await asyncio.get_running_loop().run_in_executor(None, import_telethon)
+    TelegramClient, StringSession = telethon_classes
+    return TelegramClient(StringSession(session_string), api_id, api_hash)
+
+def create_pyrogram_client(name, api_id, api_hash, **kwargs):
+    return Client(name, api_id=api_id, api_hash=api_hash, in_memory=True, **kwargs)
+
+# Pool of pre-generated MTProto auth keys. The DH key exchange is most of
+# the wait behind tg_client.connect(); auth keys aren't tied to an api_id,
+# so keys made in the background with the bot's own credentials are handed
+# to user clients and thrown away after a single use
+PYROGRAM_SESSION_FORMAT = ">BI?256sQ?"  # dc_id, api_id, test_mode, auth_key, user_id, is_bot
+
+def pyrogram_session_string(warm_key, api_id):
+    dc_id, test_mode, auth_key = warm_key
+    # user_id 0 instead of None makes Pyrogram treat the storage as filled
+    # and reuse the key; sign_in/sign_in_bot overwrite the identity later
+    packed = struct.pack(PYROGRAM_SESSION_FORMAT, dc_id, api_id, test_mode, auth_key, 0, False)
+    return base64.urlsafe_b64encode(packed).decode().rstrip("=")
+
+class AuthKeyPool:
+    def __init__(self, size, max_age):
+        self.size = size
+        self.max_age = max_age
+        self.keys = {"pyrogram": deque(), "telethon": deque()}
+        self.hits = 0
+        self.misses = 0
+        self.wakeup = None
+        self.task = None
+
+    def take(self, library):
+        keys = self.keys[library]
+        while keys:
+            created, warm_key = keys.popleft()
+            if time.monotonic() - created < self.max_age:
+                self.hits += 1
+                PREWARM_HITS.inc()
+                self.refill()
+                return warm_key
+        self.misses += 1
+        PREWARM_MISSES.inc()
+        self.refill()
+        return None
+
+    def refill(self):
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def start(self):
+        if self.size <= 0 or not API_ID or not API_HASH:
+            return
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            for library, keys in self.keys.items():
+                # Expired keys are dropped here too, so the pool stays usable
+                while keys and time.monotonic() - keys[0][0] >= self.max_age:
+                    keys.popleft()
+                while len(keys) < self.size:
+                    try:
+                        keys.append((time.monotonic(), await self.create(library)))
+                    except Exception as e:
+                        logger.warning(f"Could not pre-warm {library} auth key: {e}")
+                        break
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.max_age / 2)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    async def create(self, library):
+        if library == "telethon":
+            warm_client = await create_telethon_client(None, API_ID, API_HASH)
+            await warm_client.connect()
+            try:
+                return warm_client.session.save()
+            finally:
+                await warm_client.disconnect()
+        
+        warm_client = create_pyrogram_client("prewarm", API_ID, API_HASH, no_updates=True)
+        await warm_client.connect()
+        try:
+            return (
+                await warm_client.storage.dc_id(),
+                await warm_client.storage.test_mode(),
+                await warm_client.storage.auth_key()
+            )
+        finally:
+            await warm_client.disconnect()
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def metrics(self):
+        return {
+            "pyrogram": len(self.keys["pyrogram"]),
+            "telethon": len(self.keys["telethon"]),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+auth_key_pool = AuthKeyPool(PREWARM_POOL_SIZE, PREWARM_MAX_AGE)
+
+# Write-behind queue: /start only records the user here, the flusher task
+# writes everything collected in one batch on a size threshold or timer
+class RegistrationQueue:
+    def __init__(self, store, max_batch, flush_interval, cache_size=REGISTRATION_CACHE_SIZE,
+                 last_seen_interval=LAST_SEEN_INTERVAL):
+        self.store = store
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.wakeup = None
+        self.stopping = False
+        self.task = None
+        # user_id -> (profile fingerprint, monotonic time written), LRU
+        # bounded. Filled by our own writes, so it warms up as users return
+        self.cache_size = cache_size
+        self.last_seen_interval = last_seen_interval
+        self.written = OrderedDict()
+        # Rows skipped on a cache hit. The cache only knows this process's
+        # writes, and a job on any worker may have marked the user
+        # unreachable since, so the flush asks the database and still writes
+        # those users, which marks them active again
+        self.unverified = {}
+
+    def add(self, user_id, username, first_name, last_name):
+        # Nothing to write if this profile was stored recently enough that
+        # last_seen is still fresh, and the user is still active
+        row = (user_id, username, first_name, last_name)
+        fingerprint = hash((username, first_name, last_name))
+        cached = self.written.get(user_id)
+        if cached is not None and cached[0] == fingerprint and time.monotonic() - cached[1] < self.last_seen_interval:
+            self.written.move_to_end(user_id)
+            REGISTRATIONS.inc(result="cached")
+            self.unverified[user_id] = row
+        else:
+            REGISTRATIONS.inc(result="queued")
+            # Keyed by user_id, so repeated /start from one user collapses to one row
+            self.pending[user_id] = row
+        if len(self.pending) + len(self.unverified) >= self.max_batch and self.wakeup is not None:
+            self.wakeup.set()
+
+    def forget(self, user_id):
+        # The stored row changed behind the cache's back (e.g. marked
+        # unreachable), so the next /start has to reach the database
+        self.written.pop(user_id, None)
+
+    def remember(self, rows):
+        now = time.monotonic()
+        for user_id, username, first_name, last_name in rows:
+            self.written[user_id] = (hash((username, first_name, last_name)), now)
+            self.written.move_to_end(user_id)
+        while len(self.written) > self.cache_size:
+            self.written.popitem(last=False)
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.stopping = False
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        await self.verify()
+        if not self.pending:
+            return
+        batch = list(self.pending.values())
+        self.pending = {}
+        try:
+            await self.store.add_users(batch)
+        except Exception as e:
+            # Back into the queue for the next flush, unless the same user
+            # queued a newer profile meanwhile. Nothing is remembered as written
+            logger.error(f"Error adding {len(batch)} users, will retry: {e}")
+            for row in batch:
+                self.pending.setdefault(row[0], row)
+            return
+        self.remember(batch)
+
+    async def verify(self):
+        if not self.unverified:
+            return
+        rows, self.unverified = self.unverified, {}
+        try:
+            unreachable = await self.store.get_unreachable_users(rows)
+        except Exception as e:
+            logger.error(f"Error checking {len(rows)} cached users, will retry: {e}")
+            for user_id, row in rows.items():
+                self.unverified.setdefault(user_id, row)
+            return
+        for user_id in unreachable:
+            self.forget(user_id)
+            self.pending.setdefault(user_id, rows[user_id])
+
+    async def stop(self):
+        if self.task is not None:
+            # Not cancelled: a flush taken mid-write would drop the batch it
+            # already moved out of pending. The loop exits after this flush
+            self.stopping = True
+            self.wakeup.set()
+            await self.task
+            self.task = None
+        await self.flush()
+
+registration_queue = RegistrationQueue(user_store, REGISTRATION_BATCH_SIZE, REGISTRATION_FLUSH_INTERVAL)
+
+# Initialize Pyrogram client. With BOT_SESSION_DIR set the auth key and
+# bot login survive restarts, so start() skips the handshake and sign-in
 app = Client(
     "string_session_bot",
     api_id=API_ID,
     api_hash=API_HASH,
     bot_token=BOT_TOKEN,
-    in_memory=True
+    in_memory=not BOT_SESSION_DIR,
+    workdir=BOT_SESSION_DIR or Client.WORKDIR
 )
 
+# Tracks the common update sequence (pts/qts) of handled updates and stores
+# it, so after a restart getDifference replays exactly what was missed
+class UpdateTracker:
+    def __init__(self, store, interval):
+        self.store = store
+        self.interval = interval
+        self.state = None
+        self.dirty = False
+        self.task = None
+
+    def seen(self, update):
+        # Channels keep their own pts, which must not leak into the common one
+        if self.state is None or "Channel" in type(update).__name__:
+            return
+        pts = getattr(update, "pts", None)
+        if pts and getattr(update, "pts_count", None) is not None and pts > self.state["pts"]:
+            self.state["pts"] = pts
+            self.dirty = True
+        qts = getattr(update, "qts", None)
+        if qts and qts > self.state["qts"]:
+            self.state["qts"] = qts
+            self.dirty = True
+
+    async def catch_up(self, client: Client):
+        saved = await self.store.get_update_state()
+        if saved is not None:
+            started = time.perf_counter()
+            self.state, replayed = await self.replay(client, saved)
+            mark_startup("catch_up", started)
+            logger.info(f"Replayed {replayed} updates missed while offline")
+        if self.state is None:
+            server = await client.invoke(raw.functions.updates.GetState())
+            self.state = {"pts": server.pts, "qts": server.qts, "date": server.date, "seq": server.seq}
+        await self.store.save_update_state(self.state)
+        self.task = asyncio.create_task(self.run())
+
+    async def replay(self, client: Client, state):
+        pts, qts, date = state["pts"], state["qts"], state["date"]
+        replayed = 0
+        while True:
+            diff = await client.invoke(raw.functions.updates.GetDifference(pts=pts, date=date, qts=qts))
+            if isinstance(diff, raw.types.updates.DifferenceEmpty):
+                return {"pts": pts, "qts": qts, "date": diff.date, "seq": diff.seq}, replayed
+            if isinstance(diff, raw.types.updates.DifferenceTooLong):
+                logger.warning("Too many updates missed while offline, skipping ahead")
+                return None, replayed
+            
+            if isinstance(diff, raw.types.updates.DifferenceSlice):
+                new_state = diff.intermediate_state
+            else:
+                new_state = diff.state
+            users = {user.id: user for user in diff.users}
+            chats = {chat.id: chat for chat in diff.chats}
+            # Same shape Pyrogram's own update handling hands to the dispatcher
+            for message in diff.new_messages:
+                update = raw.types.UpdateNewMessage(message=message, pts=new_state.pts, pts_count=-1)
+                client.dispatcher.updates_queue.put_nowait((update, users, chats))
+            for update in diff.other_updates:
+                client.dispatcher.updates_queue.put_nowait((update, users, chats))
+            replayed += len(diff.new_messages) + len(diff.other_updates)
+            
+            pts, qts, date = new_state.pts, new_state.qts, new_state.date
+            if isinstance(diff, raw.types.updates.Difference):
+                return {"pts": pts, "qts": qts, "date": date, "seq": new_state.seq}, replayed
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.save()
+
+    async def save(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        self.state["date"] = int(time.time())
+        try:
+            await self.store.save_update_state(self.state)
+        except Exception as e:
+            self.dirty = True
+            logger.warning(f"Could not save update state: {e}")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.state is not None:
+            await self.save()
+
+update_tracker = UpdateTracker(user_store, UPDATE_STATE_INTERVAL)
+
 # Text messages
 START_TEXT = """
 **🤖 Welcome to String Session Generator Bot!**
@@ -93,6 +1647,23 @@ ABOUT_TEXT = """
 **Owner:** @ShriBots
 """
 
+PROMOTION_TEXT = """
+🤖 **String Session Generator Bot**
+
+Generate Pyrogram & Telethon string sessions easily!
+
+**Features:**
+• Pyrogram v2 Sessions
+• Telethon Sessions  
+• Bot String Sessions
+• User String Sessions
+• Fast & Secure
+
+**Start Now:** @{} (your bot username)
+
+Perfect for developers and bot makers! 🚀
+"""
+
 # Button layouts
 START_BUTTONS = InlineKeyboardMarkup([
     [InlineKeyboardButton("🚀 Generate Session", callback_data="generate")],
@@ -124,48 +1695,29 @@ ADMIN_BUTTONS = InlineKeyboardMarkup([
     [InlineKeyboardButton("📊 Stats", callback_data="stats")],
     [InlineKeyboardButton("📢 Broadcast", callback_data="broadcast")],
     [InlineKeyboardButton("👥 Promote in Groups", callback_data="promote")],
+    [InlineKeyboardButton("🔬 Profile", callback_data="profile")],
     [InlineKeyboardButton("🏠 Home", callback_data="home")]
 ])
 
-# Database functions
-def add_user(user_id, username, first_name, last_name):
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    try:
-        c.execute("INSERT OR REPLACE INTO users (user_id, username, first_name, last_name) VALUES (?, ?, ?, ?)",
-                  (user_id, username, first_name, last_name))
-        conn.commit()
-    except Exception as e:
-        logger.error(f"Error adding user: {e}")
-    finally:
-        conn.close()
-
-def get_all_users():
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute("SELECT user_id FROM users")
-    users = [row[0] for row in c.fetchall()]
-    conn.close()
-    return users
-
-def get_total_users():
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM users")
-    count = c.fetchone()[0]
-    conn.close()
-    return count
+# Runs before every other handler: tracks the update sequence and records
+# the time to the first handled update
+@app.on_raw_update(group=-1)
+async def raw_update_hook(client: Client, update, users, chats):
+    update_tracker.seen(update)
+    if "first_update" not in startup_timings:
+        mark_startup("first_update", STARTUP_BEGAN)
+        logger.info(f"Startup timings: {startup_report()}")
 
 # Start Command
 @app.on_message(filters.command("start") & filters.private)
+@timed_handler("start_command")
 async def start_command(client: Client, message: Message):
     user_id = message.from_user.id
     # Clear any existing session data
-    if user_id in user_sessions:
-        del user_sessions[user_id]
+    await end_session(user_id)
     
-    # Add user to database
-    add_user(
+    # Queue user for the next batched database write
+    registration_queue.add(
         user_id,
         message.from_user.username,
         message.from_user.first_name,
@@ -197,6 +1749,7 @@ async def start_command(client: Client, message: Message):
 
 # Help Command
 @app.on_message(filters.command("help") & filters.private)
+@timed_handler("help_command")
 async def help_command(client: Client, message: Message):
     await message.reply_text(
         HELP_TEXT,
@@ -206,6 +1759,7 @@ async def help_command(client: Client, message: Message):
 
 # About Command  
 @app.on_message(filters.command("about") & filters.private)
+@timed_handler("about_command")
 async def about_command(client: Client, message: Message):
     await message.reply_text(
         ABOUT_TEXT,
@@ -215,82 +1769,217 @@ async def about_command(client: Client, message: Message):
 
 # Admin Command (Owner only)
 @app.on_message(filters.command("admin") & filters.private & filters.user(OWNER_ID))
+@timed_handler("admin_command")
 async def admin_command(client: Client, message: Message):
     await message.reply_text(
         "**👑 Admin Panel**\n\nChoose an option:",
         reply_markup=ADMIN_BUTTONS
     )
 
+# Audience segments: leading key=value words of /broadcast and /promote
+SEGMENT_TOKEN = re.compile(r"(joined|seen|lib|quiet)=(\S*)\s*")
+SEGMENT_HELP = (
+    "**🎯 Target a segment** (optional, before the message):\n"
+    "`joined=2024-01-01..2024-06-30` joined in a date range (either end optional)\n"
+    "`seen=30` started the bot in the last 30 days\n"
+    "`lib=pyrogram` / `lib=telethon` generated a session with that library\n"
+    "`quiet=7` skip users messaged by a broadcast in the last 7 days"
+)
+
+def parse_date(value):
+    return datetime.date.fromisoformat(value).isoformat()
+
+def parse_segment(text):
+    # Returns (segment, rest of the text); raises ValueError on a bad filter
+    segment = {}
+    while True:
+        match = SEGMENT_TOKEN.match(text)
+        if match is None:
+            return segment, text
+        key, value = match.groups()
+        text = text[match.end():]
+        try:
+            if key == "joined":
+                # A single date means joined on that day
+                joined_from, separator, joined_to = value.partition("..")
+                if not separator:
+                    joined_to = joined_from
+                if not joined_from and not joined_to:
+                    raise ValueError
+                if joined_from:
+                    segment["joined_from"] = parse_date(joined_from)
+                if joined_to:
+                    segment["joined_to"] = parse_date(joined_to)
+            elif key == "lib":
+                if value not in ("pyrogram", "telethon"):
+                    raise ValueError
+                segment["library"] = value
+            else:
+                days = int(value)
+                if days <= 0:
+                    raise ValueError
+                segment["seen_days" if key == "seen" else "quiet_days"] = days
+        except ValueError:
+            raise ValueError(f"Invalid filter `{key}={value}`")
+
+def describe_segment(segment):
+    if not segment:
+        return "all users"
+    parts = []
+    if "joined_from" in segment or "joined_to" in segment:
+        parts.append(f"joined {segment.get('joined_from', '…')}..{segment.get('joined_to', '…')}")
+    if "seen_days" in segment:
+        parts.append(f"seen in {segment['seen_days']}d")
+    if "library" in segment:
+        parts.append(f"{segment['library'].capitalize()} users")
+    if "quiet_days" in segment:
+        parts.append(f"not messaged in {segment['quiet_days']}d")
+    return ", ".join(parts)
+
+def segment_and_content(message: Message):
+    # Splits a /broadcast or /promote into its segment and its message,
+    # which is either the reply or the text after the filters
+    text = message.text.split(None, 1)[1] if len(message.command) > 1 else ""
+    segment, text = parse_segment(text)
+    if message.reply_to_message:
+        return segment, message.reply_to_message
+    return segment, text or None
+
 # Broadcast Command (Owner only)
 @app.on_message(filters.command("broadcast") & filters.private & filters.user(OWNER_ID))
+@timed_handler("broadcast_command")
 async def broadcast_command(client: Client, message: Message):
     if message.from_user.id != OWNER_ID:
         return
     
-    if len(message.command) == 1 and not message.reply_to_message:
+    try:
+        segment, broadcast_msg = segment_and_content(message)
+    except ValueError as e:
+        await message.reply_text(f"❌ {e}\n\n{SEGMENT_HELP}")
+        return
+    
+    if broadcast_msg is None:
         await message.reply_text(
             "**📢 Broadcast Usage:**\n"
             "`/broadcast your_message_here`\n\n"
-            "Or reply to a message with `/broadcast`"
+            "Or reply to a message with `/broadcast`\n\n"
+            f"{SEGMENT_HELP}\n\n"
+            "Example: `/broadcast seen=30 quiet=7 your_message_here`"
         )
         return
     
-    # Get broadcast message
-    if message.reply_to_message:
-        broadcast_msg = message.reply_to_message
-    else:
-        broadcast_msg = message.text.split(" ", 1)[1]
-    
-    await message.reply_text("🔄 Starting broadcast to all users...")
-    await start_broadcast(client, message, broadcast_msg)
+    await start_broadcast(client, message, broadcast_msg, segment)
 
 # Promote Command (Owner only) - For groups promotion
 @app.on_message(filters.command("promote") & filters.private & filters.user(OWNER_ID))
+@timed_handler("promote_command")
 async def promote_command(client: Client, message: Message):
     if message.from_user.id != OWNER_ID:
         return
     
-    if len(message.command) == 1 and not message.reply_to_message:
+    try:
+        segment, promote_msg = segment_and_content(message)
+    except ValueError as e:
+        await message.reply_text(f"❌ {e}\n\n{SEGMENT_HELP}")
+        return
+    
+    if promote_msg is None:
         await message.reply_text(
             "**👥 Promote in Groups**\n\n"
             "Send promotion message in this format:\n"
             "`/promote your_promotion_message`\n\n"
             "Or reply to a message with `/promote`\n\n"
-            "This will send your bot promotion to all saved users!"
+            "This will send your bot promotion to all saved users!\n\n"
+            f"{SEGMENT_HELP}"
         )
         return
     
-    # Get promotion message
-    if message.reply_to_message:
-        promote_msg = message.reply_to_message
-    else:
-        promote_msg = message.text.split(" ", 1)[1]
+    await start_promotion(client, message, promote_msg, segment)
+
+# Stats text shared by /stats and the Stats button, built only from the
+# precomputed counters and per-day join totals
+STATS_DAYS = 7
+STATS_WEEKS = 8
+
+def histogram_lines(rows, width=12):
+    peak = max((count for _, count in rows), default=0) or 1
+    return "\n".join(f"`{label} {'█' * round(count * width / peak):<{width}} {count}`" for label, count in rows)
+
+async def stats_text():
+    counts = await user_store.get_user_counts()
+    total_users = sum(counts.values())
+    reachable = counts.get("active", 0)
+    join_days = await user_store.get_join_days(STATS_WEEKS * 7)
+    active_sessions = await session_backend.count()
+    admission = login_admission.metrics()
     
-    await message.reply_text("🔄 Starting promotion in groups...")
-    await start_promotion(client, message, promote_msg)
+    # Day buckets by UTC date, like date_joined; weeks end today
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    days = [today - datetime.timedelta(days=offset) for offset in range(STATS_WEEKS * 7)]
+    per_day = [(day.strftime("%a %d"), join_days.get(day.isoformat(), 0)) for day in reversed(days[:STATS_DAYS])]
+    per_week = [
+        (days[week * 7].strftime("%b %d"),
+         sum(join_days.get(day.isoformat(), 0) for day in days[week * 7:week * 7 + 7]))
+        for week in reversed(range(STATS_WEEKS))
+    ]
+    
+    reach_rate = reachable * 100 / total_users if total_users else 0.0
+    return (
+        f"**📊 Bot Statistics:**\n\n"
+        f"• Total Users: {total_users}\n"
+        f"• Reachable: {reachable} ({reach_rate:.1f}%)\n"
+        f"• Unreachable: {counts.get('blocked', 0)} blocked, {counts.get('deactivated', 0)} deleted, "
+        f"{counts.get('not_found', 0)} not found\n"
+        f"• New Users: {per_day[-1][1]} today, {sum(count for _, count in per_day)} in {STATS_DAYS} days\n"
+        f"• Active Sessions: {active_sessions}\n"
+        f"• Live Clients: {len(live_clients)}\n"
+        f"• Login Queue: {admission['active']}/{admission['limit']} active, {admission['queued']} waiting "
+        f"(avg wait {admission['avg_wait']:.1f}s)\n"
+        f"• Step Timeouts: {SESSION_STAGE_TIMEOUTS.total()}\n"
+        f"• Owner: @ShriBots\n"
+        f"• Framework: Pyrogram\n"
+        f"• Status: ✅ Running\n\n"
+        f"**📈 New users per day:**\n{histogram_lines(per_day)}\n\n"
+        f"**📈 New users per week (ending):**\n{histogram_lines(per_week)}"
+    )
 
 # Stats Command (Owner only)
 @app.on_message(filters.command("stats") & filters.private & filters.user(OWNER_ID))
+@timed_handler("stats_command")
 async def stats_command(client: Client, message: Message):
     if message.from_user.id != OWNER_ID:
         return
     
-    total_users = get_total_users()
-    await message.reply_text(
-        f"**📊 Bot Statistics:**\n\n"
-        f"• Total Users: {total_users}\n"
-        f"• Active Sessions: {len(user_sessions)}\n"
-        f"• Owner: @ShriBots\n"
-        f"• Framework: Pyrogram\n"
-        f"• Status: ✅ Running"
-    )
+    await message.reply_text(await stats_text())
+
+# Profile Command (Owner only)
+@app.on_message(filters.command("profile") & filters.private & filters.user(OWNER_ID))
+@timed_handler("profile_command")
+async def profile_command(client: Client, message: Message):
+    if message.from_user.id != OWNER_ID:
+        return
+    
+    seconds = PROFILE_DEFAULT_SECONDS
+    if len(message.command) > 1:
+        try:
+            seconds = float(message.command[1])
+        except ValueError:
+            seconds = 0
+        if not 0 < seconds <= PROFILE_MAX_SECONDS:
+            await message.reply_text(
+                "**🔬 Profile Usage:**\n"
+                f"`/profile seconds` (up to {PROFILE_MAX_SECONDS:.0f})"
+            )
+            return
+    
+    start_profile(client, message.chat.id, seconds)
 
 # Generate Command
 @app.on_message(filters.command("generate") & filters.private)
+@timed_handler("generate_command")
 async def generate_command(client: Client, message: Message):
     user_id = message.from_user.id
-    if user_id in user_sessions:
-        del user_sessions[user_id]
+    await end_session(user_id)
     
     await message.reply_text(
         "**Choose the library you want to generate string session for:**",
@@ -299,23 +1988,33 @@ async def generate_command(client: Client, message: Message):
 
 # Cancel Command
 @app.on_message(filters.command("cancel") & filters.private)
+@timed_handler("cancel_command")
 async def cancel_command(client: Client, message: Message):
     user_id = message.from_user.id
-    if user_id in user_sessions:
-        del user_sessions[user_id]
+    if await session_backend.get(user_id) is not None:
+        await end_session(user_id)
         await message.reply_text("❌ Process cancelled!")
     else:
         await message.reply_text("❌ No active process to cancel!")
 
 # Callback Query Handler
+# Known button payloads, so the latency histogram's "kind" label stays bounded
+CALLBACK_KINDS = {
+    "home", "help", "about", "admin", "stats", "broadcast", "promote", "profile", "generate",
+    "pyrogram", "telethon", "pyrogram_bot", "telethon_bot"
+}
+
+def callback_kind(callback_query):
+    return callback_query.data if callback_query.data in CALLBACK_KINDS else "other"
+
 @app.on_callback_query()
+@timed_handler("callback_handler", callback_kind)
 async def callback_handler(client: Client, callback_query: CallbackQuery):
     user_id = callback_query.from_user.id
     query = callback_query.data
     
     if query == "home":
-        if user_id in user_sessions:
-            del user_sessions[user_id]
+        await end_session(user_id)
         
         if user_id == OWNER_ID:
             buttons = InlineKeyboardMarkup([
@@ -364,16 +2063,7 @@ async def callback_handler(client: Client, callback_query: CallbackQuery):
     
     elif query == "stats":
         if user_id == OWNER_ID:
-            total_users = get_total_users()
-            await callback_query.message.edit_text(
-                f"**📊 Bot Statistics:**\n\n"
-                f"• Total Users: {total_users}\n"
-                f"• Active Sessions: {len(user_sessions)}\n"
-                f"• Owner: @ShriBots\n"
-                f"• Framework: Pyrogram\n"
-                f"• Status: ✅ Running",
-                reply_markup=ADMIN_BUTTONS
-            )
+            await callback_query.message.edit_text(await stats_text(), reply_markup=ADMIN_BUTTONS)
         else:
             await callback_query.answer("❌ Access Denied! Owner only.", show_alert=True)
     
@@ -383,12 +2073,20 @@ async def callback_handler(client: Client, callback_query: CallbackQuery):
                 "**📢 Broadcast**\n\n"
                 "Send your broadcast message in this format:\n"
                 "`/broadcast your_message`\n\n"
-                "Or reply to a message with `/broadcast`",
+                "Or reply to a message with `/broadcast`\n\n"
+                f"{SEGMENT_HELP}",
                 reply_markup=ADMIN_BUTTONS
             )
         else:
             await callback_query.answer("❌ Access Denied! Owner only.", show_alert=True)
     
+    elif query == "profile":
+        if user_id == OWNER_ID:
+            await callback_query.answer(f"🔬 Profiling for {PROFILE_DEFAULT_SECONDS:.0f}s...")
+            start_profile(client, callback_query.message.chat.id, PROFILE_DEFAULT_SECONDS)
+        else:
+            await callback_query.answer("❌ Access Denied! Owner only.", show_alert=True)
+    
     elif query == "promote":
         if user_id == OWNER_ID:
             await callback_query.message.edit_text(
@@ -396,7 +2094,8 @@ async def callback_handler(client: Client, callback_query: CallbackQuery):
                 "Send promotion message in this format:\n"
                 "`/promote your_promotion_message`\n\n"
                 "Or reply to a message with `/promote`\n\n"
-                "This will promote your bot to all saved users!",
+                "This will promote your bot to all saved users!\n\n"
+                f"{SEGMENT_HELP}",
                 reply_markup=ADMIN_BUTTONS
             )
         else:
@@ -411,11 +2110,16 @@ async def callback_handler(client: Client, callback_query: CallbackQuery):
     elif query in ["pyrogram", "telethon", "pyrogram_bot", "telethon_bot"]:
         await callback_query.answer()
         
+        # Start loading Telethon now so it's ready by the time the client is built
+        if "telethon" in query and telethon_classes is None:
+            asyncio.get_running_loop().run_in_executor(None, import_telethon)
+        
         # Initialize user session
-        user_sessions[user_id] = {
+        await end_session(user_id)
+        await save_session(user_id, {
             "library": query,
             "step": "api_id"
-        }
+        })
         
         await callback_query.message.edit_text(
             "**Please send your API_ID:**\n\n"
@@ -424,15 +2128,24 @@ async def callback_handler(client: Client, callback_query: CallbackQuery):
         )
 
 # Message handler for session generation
-@app.on_message(filters.private & filters.text & ~filters.command(["start", "help", "about", "cancel", "generate", "admin", "broadcast", "stats", "promote"]))
+@app.on_message(filters.private & filters.text & ~filters.command(["start", "help", "about", "cancel", "generate", "admin", "broadcast", "stats", "promote", "profile"]))
 async def message_handler(client: Client, message: Message):
     user_id = message.from_user.id
     
-    if user_id not in user_sessions:
+    session_data = await load_session(user_id)
+    if session_data is None:
+        return
+    
+    owner = session_data.get("worker", WORKER_ID)
+    if owner != WORKER_ID:
+        if not await session_relay.forward(owner, "message", user_id, message.chat.id, message.text):
+            await message.reply_text("❌ Session expired! Please start again with /generate")
+            await end_session(user_id)
         return
     
-    session_data = user_sessions[user_id]
     user_input = message.text.strip()
+    step = session_data["step"]
+    started = time.perf_counter()
     
     try:
         if session_data["step"] == "api_id":
@@ -441,6 +2154,7 @@ async def message_handler(client: Client, message: Message):
                 api_id = int(user_input)
                 session_data["api_id"] = api_id
                 session_data["step"] = "api_hash"
+                await save_session(user_id, session_data)
                 
                 await message.reply_text(
                     "**Please send your API_HASH:**\n\n"
@@ -449,12 +2163,13 @@ async def message_handler(client: Client, message: Message):
                 )
             except ValueError:
                 await message.reply_text("❌ Invalid API_ID! It must be a number. Please start again with /generate")
-                del user_sessions[user_id]
+                await end_session(user_id)
         
         elif session_data["step"] == "api_hash":
             # Store API_HASH
             session_data["api_hash"] = user_input
             session_data["step"] = "auth_data"
+            await save_session(user_id, session_data)
             
             library = session_data["library"]
             is_bot = "bot" in library
@@ -477,7 +2192,27 @@ async def message_handler(client: Client, message: Message):
         elif session_data["step"] == "auth_data":
             # Store phone number or bot token
             session_data["auth_data"] = user_input
-            await process_session_generation(client, message, session_data)
+            session_data["step"] = "queued"
+            await save_session(user_id, session_data)
+            start_login(user_id, process_session_generation(client, message, session_data))
+            
+        elif session_data["step"] == "queued":
+            position = login_admission.position(user_id)
+            if position:
+                await message.reply_text(
+                    f"⏳ Still waiting for a free slot, you are #{position} in the queue.\n\n"
+                    "Type /cancel to stop the process."
+                )
+            else:
+                await message.reply_text(
+                    "⏳ Still connecting to Telegram, please wait.\n\n"
+                    "Type /cancel to stop the process."
+                )
+            
+        elif "tg_client" not in session_data:
+            # The login client was already dropped, or this worker restarted
+            await message.reply_text("❌ Session expired! Please start again with /generate")
+            await end_session(user_id)
             
         elif session_data["step"] == "otp":
             # Process OTP
@@ -490,8 +2225,9 @@ async def message_handler(client: Client, message: Message):
     except Exception as e:
         logger.error(f"Error in message handler: {e}")
         await message.reply_text("❌ An error occurred. Please start again with /generate")
-        if user_id in user_sessions:
-            del user_sessions[user_id]
+        await end_session(user_id)
+    finally:
+        HANDLER_SECONDS.observe(time.perf_counter() - started, handler="message_handler", kind=step)
 
 async def process_session_generation(client: Client, message: Message, session_data: dict):
     user_id = message.from_user.id
@@ -499,58 +2235,80 @@ async def process_session_generation(client: Client, message: Message, session_d
     is_bot = "bot" in library
     is_telethon = "telethon" in library
     
+    async def notify_queued(position):
+        await message.reply_text(
+            f"⏳ Too many sessions are being generated right now.\n\n"
+            f"You are #{position} in the queue, I'll continue automatically.\n\n"
+            "Type /cancel to stop the process."
+        )
+    
     try:
+        # Wait for a login client slot before opening any connection
+        try:
+            await login_admission.acquire(user_id, notify_queued)
+        except AdmissionCancelled:
+            return
+        
         await message.reply_text("🔄 Starting session generation...")
         
-        # Initialize the appropriate client
+        # Initialize the appropriate client, on a pre-warmed auth key when
+        # one is available so connect() skips the key exchange
         if is_telethon:
-            tg_client = TelegramClient(StringSession(), session_data["api_id"], session_data["api_hash"])
+            warm_key = auth_key_pool.take("telethon")
+            tg_client = await create_telethon_client(warm_key, session_data["api_id"], session_data["api_hash"])
         else:
+            warm_key = auth_key_pool.take("pyrogram")
+            session_string = pyrogram_session_string(warm_key, session_data["api_id"]) if warm_key else None
             if is_bot:
-                tg_client = Client(
+                tg_client = create_pyrogram_client(
                     "bot_session",
-                    api_id=session_data["api_id"],
-                    api_hash=session_data["api_hash"],
+                    session_data["api_id"],
+                    session_data["api_hash"],
                     bot_token=session_data["auth_data"],
-                    in_memory=True
+                    session_string=session_string
                 )
             else:
-                tg_client = Client(
-                    "user_session", 
-                    api_id=session_data["api_id"],
-                    api_hash=session_data["api_hash"],
-                    in_memory=True
+                tg_client = create_pyrogram_client(
+                    "user_session",
+                    session_data["api_id"],
+                    session_data["api_hash"],
+                    session_string=session_string
                 )
         
-        await tg_client.connect()
+        try:
+            await with_deadline("connect", tg_client.connect())
+        except (StepTimeout, asyncio.CancelledError):
+            await abort_connect(tg_client)
+            raise
         session_data["tg_client"] = tg_client
+        live_clients[user_id] = {"tg_client": tg_client}
         
         if is_bot:
             # Bot authentication
             try:
                 if is_telethon:
-                    await tg_client.start(bot_token=session_data["auth_data"])
+                    await with_deadline("sign_in_bot", tg_client.start(bot_token=session_data["auth_data"]))
                 else:
-                    await tg_client.sign_in_bot(session_data["auth_data"])
+                    await with_deadline("sign_in_bot", tg_client.sign_in_bot(session_data["auth_data"]))
                 
                 # Generate session string
                 await generate_final_session(client, message, session_data)
                 
             except Exception as e:
                 await message.reply_text(f"❌ Invalid bot token: {e}\nPlease start again with /generate")
-                await tg_client.disconnect()
-                if user_id in user_sessions:
-                    del user_sessions[user_id]
+                await close_client(tg_client)
+                await end_session(user_id)
         else:
             # User authentication - send OTP
             try:
                 if is_telethon:
-                    await tg_client.send_code_request(session_data["auth_data"])
+                    sent_code = await with_deadline("send_code", tg_client.send_code_request(session_data["auth_data"]))
                 else:
-                    sent_code = await tg_client.send_code(session_data["auth_data"])
-                    session_data["phone_code_hash"] = sent_code.phone_code_hash
+                    sent_code = await with_deadline("send_code", tg_client.send_code(session_data["auth_data"]))
+                session_data["phone_code_hash"] = sent_code.phone_code_hash
                 
                 session_data["step"] = "otp"
+                await save_session(user_id, session_data)
                 
                 await message.reply_text(
                     "**OTP sent successfully!**\n\n"
@@ -561,14 +2319,12 @@ async def process_session_generation(client: Client, message: Message, session_d
                 
             except (ApiIdInvalid, PhoneNumberInvalid):
                 await message.reply_text("❌ Invalid API_ID/API_HASH or phone number! Please start again with /generate")
-                await tg_client.disconnect()
-                if user_id in user_sessions:
-                    del user_sessions[user_id]
+                await close_client(tg_client)
+                await end_session(user_id)
                 
     except Exception as e:
         await message.reply_text(f"❌ Error: {str(e)}\nPlease start again with /generate")
-        if user_id in user_sessions:
-            del user_sessions[user_id]
+        await end_session(user_id)
 
 async def process_otp(client: Client, message: Message, session_data: dict, otp_code: str):
     user_id = message.from_user.id
@@ -579,15 +2335,18 @@ async def process_otp(client: Client, message: Message, session_data: dict, otp_
         otp_code = otp_code.replace(" ", "")
         
         if is_telethon:
-            await tg_client.sign_in(session_data["auth_data"], code=otp_code)
+            await with_deadline("sign_in", tg_client.sign_in(session_data["auth_data"], code=otp_code))
         else:
-            await tg_client.sign_in(session_data["auth_data"], session_data["phone_code_hash"], otp_code)
+            await with_deadline("sign_in", tg_client.sign_in(
+                session_data["auth_data"], session_data["phone_code_hash"], otp_code
+            ))
         
         # Generate session string
         await generate_final_session(client, message, session_data)
         
     except SessionPasswordNeeded:
         session_data["step"] = "password"
+        await save_session(user_id, session_data)
         await message.reply_text(
             "**Your account has two-step verification enabled.**\n\n"
             "Please send your password:\n\n"
@@ -595,14 +2354,12 @@ async def process_otp(client: Client, message: Message, session_data: dict, otp_
         )
     except (PhoneCodeInvalid, PhoneCodeExpired):
         await message.reply_text("❌ Invalid or expired OTP code! Please start again with /generate")
-        await tg_client.disconnect()
-        if user_id in user_sessions:
-            del user_sessions[user_id]
+        await close_client(tg_client)
+        await end_session(user_id)
     except Exception as e:
         await message.reply_text(f"❌ Error: {str(e)}\nPlease start again with /generate")
-        await tg_client.disconnect()
-        if user_id in user_sessions:
-            del user_sessions[user_id]
+        await close_client(tg_client)
+        await end_session(user_id)
 
 async def process_password(client: Client, message: Message, session_data: dict, password: str):
     user_id = message.from_user.id
@@ -611,23 +2368,21 @@ async def process_password(client: Client, message: Message, session_data: dict,
     
     try:
         if is_telethon:
-            await tg_client.sign_in(password=password)
+            await with_deadline("check_password", tg_client.sign_in(password=password))
         else:
-            await tg_client.check_password(password=password)
+            await with_deadline("check_password", tg_client.check_password(password=password))
         
         # Generate session string
         await generate_final_session(client, message, session_data)
         
     except PasswordHashInvalid:
         await message.reply_text("❌ Invalid password! Please start again with /generate")
-        await tg_client.disconnect()
-        if user_id in user_sessions:
-            del user_sessions[user_id]
+        await close_client(tg_client)
+        await end_session(user_id)
     except Exception as e:
         await message.reply_text(f"❌ Error: {str(e)}\nPlease start again with /generate")
-        await tg_client.disconnect()
-        if user_id in user_sessions:
-            del user_sessions[user_id]
+        await close_client(tg_client)
+        await end_session(user_id)
 
 async def generate_final_session(client: Client, message: Message, session_data: dict):
     user_id = message.from_user.id
@@ -640,7 +2395,7 @@ async def generate_final_session(client: Client, message: Message, session_data:
         if is_telethon:
             session_string = tg_client.session.save()
         else:
-            session_string = await tg_client.export_session_string()
+            session_string = await with_deadline("export_session", tg_client.export_session_string())
         
         # Prepare session info
         library_name = "Telethon" if is_telethon else "Pyrogram"
@@ -662,10 +2417,18 @@ async def generate_final_session(client: Client, message: Message, session_data:
         await message.reply_text(session_text)
         await message.reply_text("✅ **Session generated successfully!**")
         
+        # Remembered for library audience segments
+        try:
+            await user_store.record_generation(user_id, "telethon" if is_telethon else "pyrogram")
+        except Exception as e:
+            logger.warning(f"Could not record generation for {user_id}: {e}")
+        
         # Try to send to saved messages
         try:
             if "bot" not in library:
-                await tg_client.send_message("me", "**Your String Session:**\n\n" + session_string)
+                await with_deadline("save_copy", tg_client.send_message(
+                    "me", "**Your String Session:**\n\n" + session_string
+                ))
         except:
             pass
             
@@ -673,162 +2436,785 @@ async def generate_final_session(client: Client, message: Message, session_data:
         await message.reply_text(f"❌ Error generating session: {str(e)}")
     finally:
         # Cleanup
-        await tg_client.disconnect()
-        if user_id in user_sessions:
-            del user_sessions[user_id]
+        await close_client(tg_client)
+        await end_session(user_id)
 
-# Broadcast function (Owner only)
-async def start_broadcast(client: Client, message: Message, broadcast_msg):
+# Global send pacing for broadcasts and promotions
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        # FloodWait applies to the whole bot, so every sender waits it out
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+broadcast_bucket = TokenBucket(BROADCAST_RATE, BROADCAST_BURST)
+
+async def paced(func, *args, **kwargs):
+    for attempt in range(BROADCAST_FLOOD_RETRIES + 1):
+        await broadcast_bucket.acquire()
+        try:
+            return await func(*args, **kwargs)
+        except FloodWait as e:
+            if attempt == BROADCAST_FLOOD_RETRIES:
+                raise
+            BROADCAST_FLOOD_WAITS.inc()
+            logger.warning(f"FloodWait of {e.value}s during broadcast, pausing all sends")
+            broadcast_bucket.pause(e.value)
+
+# Why a send failed: the permanent reasons get the user skipped by later
+# broadcasts, anything else (network, exhausted FloodWait retries) is transient
+SEND_FAILURES = (
+    (UserIsBlocked, "blocked"),
+    (InputUserDeactivated, "deactivated"),
+    (PeerIdInvalid, "not_found"),
+    (UserIdInvalid, "not_found"),
+)
+
+def classify_send_error(error):
+    for error_type, result in SEND_FAILURES:
+        if isinstance(error, error_type):
+            return result
+    return "transient"
+
+async def run_broadcast(user_ids, send, on_result, concurrency=BROADCAST_CONCURRENCY):
+    # Keeps up to `concurrency` recipients in flight; pacing is up to `send`
+    # routing its API calls through paced()
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    
+    async def worker():
+        while True:
+            user_id = await queue.get()
+            if user_id is None:
+                return
+            try:
+                await send(user_id)
+                result = "sent"
+            except Exception as e:
+                result = classify_send_error(e)
+                BROADCAST_FAILURES.inc(reason=type(e).__name__)
+            BROADCAST_SENDS.inc(result=result)
+            await on_result(user_id, result)
+    
+    async def feed():
+        async for user_id in user_ids:
+            await queue.put(user_id)
+        for _ in workers:
+            await queue.put(None)
+    
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    tasks = [asyncio.create_task(feed()), *workers]
     try:
-        users = get_all_users()
-        total = len(users)
-        sent = 0
-        failed = 0
-        
-        progress_msg = await message.reply_text(f"🔄 Broadcast started...\n0/{total} | Sent: 0 | Failed: 0")
-        
-        for user_id in users:
+        # A worker whose on_result raises fails the whole run, rather than
+        # leaving feed() blocked on a queue nobody drains any more
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+# Progress messages are edited from their own task on a timer, so the send
+# pipeline only ever swaps in the latest text and never waits on an edit
+class ProgressReporter:
+    def __init__(self, edit, interval=PROGRESS_INTERVAL):
+        self.edit = edit
+        self.interval = interval
+        self.text = None
+        self.shown = None
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def update(self, text):
+        self.text = text
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.push()
+
+    async def push(self):
+        text = self.text
+        if text is None or text == self.shown:
+            return
+        try:
+            await self.edit(text)
+        except MessageNotModified:
+            pass
+        except FloodWait as e:
+            # Leave the text pending, the next tick retries it
+            await asyncio.sleep(e.value)
+            return
+        except Exception as e:
+            logger.warning(f"Progress update failed: {e}")
+        self.shown = text
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
             try:
-                if isinstance(broadcast_msg, str):
-                    await client.send_message(user_id, f"📢 **Broadcast:**\n\n{broadcast_msg}")
-                else:
-                    await broadcast_msg.copy(user_id)
-                sent += 1
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def finish(self, text):
+        await self.stop()
+        self.text = text
+        # The summary is the last edit, nothing would retry it after a
+        # FloodWait. push() has waited the flood out by then
+        while self.shown != text:
+            await self.push()
+
+# Broadcast jobs are persisted, so a restart resumes them from the last
+# checkpoint instead of starting over
+broadcast_tasks = {}  # job_id -> task
+
+async def start_job(client: Client, message: Message, kind, content, started_text, segment=None):
+    if isinstance(content, str):
+        text, from_chat_id, message_id = content, None, None
+    else:
+        text, from_chat_id, message_id = None, content.chat.id, content.id
+    
+    # The update state is only saved every UPDATE_STATE_INTERVAL, so a crash
+    # can replay a command whose job already exists (and was resumed)
+    job_id = await user_store.get_command_job(message.chat.id, message.id)
+    if job_id is not None:
+        logger.info(f"Ignoring replayed /{kind} {message.id}, it started job {job_id}")
+        return
+    
+    # Users whose earlier sends failed permanently are left out up front
+    total = await user_store.count_audience(segment)
+    progress_msg = await message.reply_text(f"{started_text}\n0/{total} | Sent: 0 | Failed: 0")
+    job = await user_store.create_job(kind, text, from_chat_id, message_id,
+                                      progress_msg.chat.id, progress_msg.id, total, segment,
+                                      (message.chat.id, message.id))
+    # Otherwise the worker holding the job lease picks it up
+    if job_leader.leading:
+        spawn_job(client, job)
+
+def spawn_job(client: Client, job):
+    job_id = job["job_id"]
+    task = asyncio.create_task(run_job(client, job))
+    broadcast_tasks[job_id] = task
+    task.add_done_callback(lambda done: broadcast_tasks.pop(job_id, None))
+
+async def resume_jobs(client: Client):
+    for job in await user_store.get_running_jobs():
+        if job["job_id"] in broadcast_tasks:
+            continue
+        if job["sent"] + job["failed"] == 0:
+            # Never got going, its progress message is still current
+            spawn_job(client, job)
+            continue
+        logger.info(f"Resuming {job['kind']} job {job['job_id']} after user {job['cursor']}")
+        try:
+            progress_msg = await client.send_message(
+                job["progress_chat_id"],
+                f"♻️ Resuming {job['kind']}...\n"
+                f"{job['sent'] + job['failed']}/{job['total']} | Sent: {job['sent']} | Failed: {job['failed']}"
+            )
+            job["progress_message_id"] = progress_msg.id
+            await user_store.set_job_progress_message(job["job_id"], progress_msg.id)
+        except Exception as e:
+            logger.error(f"Could not post resume notice for job {job['job_id']}: {e}")
+        spawn_job(client, job)
+
+async def stop_jobs():
+    tasks = list(broadcast_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+# Workers sharing users.db all accept /broadcast and /promote, but only the
+# holder of the "jobs" lease runs jobs. A job is then never sent twice, and
+# BROADCAST_RATE stays the rate of the bot as a whole
+class JobLeader:
+    def __init__(self, store, owner, lease_seconds):
+        self.store = store
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.leading = False
+        self.task = None
+
+    def start(self, client):
+        self.task = asyncio.create_task(self.run(client))
+
+    async def run(self, client):
+        while True:
+            try:
+                await self.renew(client)
             except Exception as e:
-                failed += 1
-            
-            # Update progress every 10 users
-            if sent % 10 == 0 or sent + failed == total:
-                await progress_msg.edit_text(
-                    f"🔄 Broadcasting...\n{sent + failed}/{total} | Sent: {sent} | Failed: {failed}"
-                )
-            
-            # Small delay to avoid flooding
-            await asyncio.sleep(0.1)
-        
-        await progress_msg.edit_text(
+                logger.warning(f"Job lease renewal failed: {e}")
+            await asyncio.sleep(self.lease_seconds / 3)
+
+    async def renew(self, client):
+        leading = await self.store.acquire_lease("jobs", self.owner, self.lease_seconds)
+        if leading != self.leading:
+            logger.info(f"{'Took' if leading else 'Lost'} the job lease")
+        if self.leading and not leading:
+            # Another worker runs them from their last checkpoint now
+            await stop_jobs()
+        self.leading = leading
+        if leading:
+            # Jobs interrupted by a shutdown, or started on another worker
+            await resume_jobs(client)
+            await self.store.purge_finished_jobs()
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await stop_jobs()
+        if self.leading:
+            # Checkpointed, so the next worker can take over right away
+            self.leading = False
+            try:
+                await self.store.release_lease("jobs", self.owner)
+            except Exception as e:
+                logger.warning(f"Could not release the job lease: {e}")
+
+job_leader = JobLeader(user_store, WORKER_ID, JOB_LEASE_SECONDS)
+
+async def run_job(client: Client, job):
+    job_id = job["job_id"]
+    total = job["total"]
+    sent = job["sent"]
+    failed = job["failed"]
+    in_flight = set()
+    last_dispatched = job["cursor"]
+    results = []
+    segment = json.loads(job["segment"]) if job.get("segment") else None
+    
+    if job["kind"] == "broadcast":
+        send = broadcast_sender(client, job)
+        progress_label = "🔄 Broadcasting..."
+    else:
+        send = await promotion_sender(client, job)
+        progress_label = "🔄 Promoting..."
+    
+    async def edit_progress(text):
+        await client.edit_message_text(job["progress_chat_id"], job["progress_message_id"], text)
+    
+    progress = ProgressReporter(edit_progress)
+    
+    async def recipients():
+        nonlocal last_dispatched
+        async for user_id in user_store.iter_job_recipients(job_id, job["cursor"], segment):
+            in_flight.add(user_id)
+            last_dispatched = user_id
+            yield user_id
+    
+    async def checkpoint(status="running"):
+        nonlocal results
+        # Users are dispatched in id order, so everything below the oldest
+        # unfinished recipient is done
+        cursor = min(in_flight) - 1 if in_flight else last_dispatched
+        batch, results = results, []
+        await user_store.checkpoint_job(job_id, batch, sent, failed, cursor, status)
+    
+    async def on_result(user_id, result):
+        nonlocal sent, failed
+        in_flight.discard(user_id)
+        if result == "sent":
+            sent += 1
+        else:
+            failed += 1
+            if result != "transient":
+                registration_queue.forget(user_id)
+        results.append((user_id, result))
+        progress.update(f"{progress_label}\n{sent + failed}/{total} | Sent: {sent} | Failed: {failed}")
+        if len(results) >= JOB_CHECKPOINT_EVERY:
+            await checkpoint()
+    
+    progress.start()
+    try:
+        await run_broadcast(recipients(), send, on_result)
+        await checkpoint("done")
+    except asyncio.CancelledError:
+        # Shutting down: keep what finished so the restart picks up from here
+        await progress.stop()
+        await checkpoint()
+        raise
+    except Exception as e:
+        logger.error(f"{job['kind'].capitalize()} job {job_id} failed: {e}")
+        await progress.stop()
+        await checkpoint("failed")
+        await user_store.purge_job_recipients(job_id)
+        await client.send_message(job["progress_chat_id"], f"❌ {job['kind'].capitalize()} error: {str(e)}")
+        return
+    
+    success_rate = (sent / total) * 100 if total else 0.0
+    # Counted over every stored result at "done", so resumed jobs count fully
+    counts = await user_store.get_job_result_counts(job_id)
+    await user_store.purge_job_recipients(job_id)
+    failure_text = (
+        f"{counts.get('blocked', 0)} blocked, {counts.get('deactivated', 0)} deleted, "
+        f"{counts.get('not_found', 0)} not found, {counts.get('transient', 0) + counts.get('failed', 0)} other"
+    )
+    if job["kind"] == "broadcast":
+        await progress.finish(
             f"✅ **Broadcast Completed!**\n\n"
             f"• Total Users: {total}\n"
             f"• Sent: {sent}\n"
-            f"• Failed: {failed}\n"
-            f"• Success Rate: {(sent/total)*100:.1f}%"
+            f"• Failed: {failed} ({failure_text})\n"
+            f"• Success Rate: {success_rate:.1f}%"
         )
-        
+    else:
+        await progress.finish(
+            f"✅ **Promotion Completed!**\n\n"
+            f"• Total Users: {total}\n"
+            f"• Promotion Sent: {sent}\n"
+            f"• Failed: {failed} ({failure_text})\n"
+            f"• Success Rate: {success_rate:.1f}%\n\n"
+            f"🎯 Your bot has been promoted to {sent} users!"
+        )
+
+def broadcast_sender(client: Client, job):
+    async def send(user_id):
+        if job["text"] is not None:
+            await paced(client.send_message, user_id, f"📢 **Broadcast:**\n\n{job['text']}")
+        else:
+            await paced(client.copy_message, user_id, job["from_chat_id"], job["message_id"])
+    return send
+
+async def promotion_sender(client: Client, job):
+    # Rendered once per job rather than once per recipient
+    bot = await bot_profile.get(client)
+    promotion_text = PROMOTION_TEXT.format(bot.username)
+    if job["text"] is not None:
+        # Combine default promotion with custom message
+        final_msg = promotion_text + f"\n\n**Additional Message:**\n{job['text']}"
+    
+    async def send(user_id):
+        if job["text"] is not None:
+            await paced(client.send_message, user_id, final_msg)
+        else:
+            # Send both messages
+            await paced(client.send_message, user_id, promotion_text)
+            await paced(client.copy_message, user_id, job["from_chat_id"], job["message_id"])
+    return send
+
+# Broadcast function (Owner only)
+async def start_broadcast(client: Client, message: Message, broadcast_msg, segment=None):
+    try:
+        await start_job(client, message, "broadcast", broadcast_msg,
+                        f"🔄 Broadcast to {describe_segment(segment)} started...", segment)
     except Exception as e:
         await message.reply_text(f"❌ Broadcast error: {str(e)}")
 
 # Promotion function (Owner only) - For groups promotion
-async def start_promotion(client: Client, message: Message, promote_msg):
+async def start_promotion(client: Client, message: Message, promote_msg, segment=None):
     try:
-        users = get_all_users()
-        total = len(users)
-        sent = 0
-        failed = 0
+        await start_job(client, message, "promotion", promote_msg,
+                        f"🔄 Promotion to {describe_segment(segment)} started...", segment)
+    except Exception as e:
+        await message.reply_text(f"❌ Promotion error: {str(e)}")
+
+# Loop watchdog: a heartbeat task stamps the time on every tick and records
+# how late it woke up. A plain thread watches the stamp, and once the loop has
+# been blocked past the threshold it grabs the loop thread's stack, which is
+# the code doing the blocking, while it is still running
+class LoopWatchdog:
+    def __init__(self, interval, threshold, window):
+        self.interval = interval
+        self.threshold = threshold
+        self.lags = deque(maxlen=max(1, int(window / interval)))
+        self.stalls = deque(maxlen=5)
+        self.beat = time.monotonic()
+        self.loop_thread_id = None
+        self.task = None
+        self.thread = None
+        self.stopping = threading.Event()
+    
+    def start(self):
+        self.loop_thread_id = threading.get_ident()
+        self.beat = time.monotonic()
+        self.task = asyncio.create_task(self.heartbeat())
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.watch, name="loop-watchdog", daemon=True)
+        self.thread.start()
+    
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - self.beat - self.interval)
+            self.beat = now
+            self.lags.append(lag)
+            if lag >= self.threshold:
+                logger.warning(f"Event loop was blocked for {lag:.2f}s")
+    
+    def watch(self):
+        reported = None
+        while not self.stopping.wait(self.interval):
+            beat = self.beat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked < self.threshold or beat == reported:
+                continue
+            # One capture per stall; the beat changes once the loop is free
+            reported = beat
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame))
+            self.stalls.append({"at": time.time(), "blocked": round(blocked, 3), "stack": stack})
+            LOOP_STALLS.inc()
+            logger.warning(f"Event loop blocked for {blocked:.2f}s, loop thread is at:\n{stack}")
+    
+    def lag(self):
+        # Worst lag in the window, or the current stall if the loop is stuck
+        # right now (only visible from another thread)
+        current = max(0.0, time.monotonic() - self.beat - self.interval)
+        return max(max(self.lags, default=0.0), current)
+    
+    async def stop(self):
+        self.stopping.set()
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+# Sampling profiler: a thread reads every other thread's stack at a fixed
+# interval. Nothing is hooked into the profiled code, so the cost is one
+# stack walk per sample and the bot runs at normal speed meanwhile
+class SamplingProfiler:
+    def __init__(self, interval):
+        self.interval = interval
+        self.running = False
+    
+    @staticmethod
+    def frame_name(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    
+    def sample(self, seconds):
+        stacks = {}
+        samples = 0
+        skip = {threading.get_ident()}
+        if loop_watchdog.thread is not None:
+            skip.add(loop_watchdog.thread.ident)
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in skip:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self.frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                key = tuple(reversed(stack))
+                stacks[key] = stacks.get(key, 0) + 1
+            samples += 1
+            time.sleep(self.interval)
+        return stacks, samples
+    
+    async def run(self, seconds):
+        # Returns None if another profile is already running
+        if self.running:
+            return None
+        self.running = True
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.sample, seconds)
+        finally:
+            self.running = False
+    
+    @staticmethod
+    def summary(stacks, samples, top):
+        # Self time is the innermost frame, total time counts a function
+        # once per stack it appears in
+        own = {}
+        total = {}
+        for stack, count in stacks.items():
+            own[stack[-1]] = own.get(stack[-1], 0) + count
+            for name in set(stack[1:]):
+                total[name] = total.get(name, 0) + count
         
-        progress_msg = await message.reply_text(f"🔄 Promotion started...\n0/{total} | Sent: 0 | Failed: 0")
+        def rows(counts):
+            ranked = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:top]
+            return "\n".join(f"`{count * 100 / samples:5.1f}% {name}`" for name, count in ranked)
         
-        for user_id in users:
-            try:
-                # Send promotion message
-                promotion_text = """
-🤖 **String Session Generator Bot**
+        return f"**Self:**\n{rows(own)}\n\n**Total:**\n{rows(total)}"
+    
+    @staticmethod
+    def collapsed(stacks):
+        # Brendan Gregg's folded format, input for flamegraph.pl / speedscope
+        return "\n".join(f"{';'.join(stack)} {count}" for stack, count in stacks.items()) + "\n"
 
-Generate Pyrogram & Telethon string sessions easily!
+profiler = SamplingProfiler(PROFILE_SAMPLE_INTERVAL)
 
-**Features:**
-• Pyrogram v2 Sessions
-• Telethon Sessions  
-• Bot String Sessions
-• User String Sessions
-• Fast & Secure
+async def send_profile(client, chat_id, seconds):
+    if profiler.running:
+        await client.send_message(chat_id, "❌ A profile is already running!")
+        return
+    status = await client.send_message(chat_id, f"🔬 Profiling for {seconds:g}s...")
+    result = await profiler.run(seconds)
+    if result is None:
+        await status.edit_text("❌ A profile is already running!")
+        return
+    stacks, samples = result
+    if not samples:
+        await status.edit_text("❌ No samples collected")
+        return
+    
+    await status.edit_text(
+        f"**🔬 Profile: {seconds:g}s, {samples} samples**\n\n"
+        + SamplingProfiler.summary(stacks, samples, PROFILE_TOP)
+    )
+    document = io.BytesIO(SamplingProfiler.collapsed(stacks).encode())
+    document.name = f"profile-{time.strftime('%Y%m%d-%H%M%S')}.collapsed"
+    await client.send_document(chat_id, document, caption="Collapsed stacks, e.g. `flamegraph.pl profile.collapsed > profile.svg`")
 
-**Start Now:** @{} (your bot username)
+# The window can run for minutes, far too long to hold a dispatcher worker
+profile_tasks = set()
 
-Perfect for developers and bot makers! 🚀
-""".format((await client.get_me()).username)
-                
-                if isinstance(promote_msg, str):
-                    # Combine default promotion with custom message
-                    final_msg = promotion_text + f"\n\n**Additional Message:**\n{promote_msg}"
-                    await client.send_message(user_id, final_msg)
-                else:
-                    # Send both messages
-                    await client.send_message(user_id, promotion_text)
-                    await promote_msg.copy(user_id)
-                
-                sent += 1
-            except Exception as e:
-                failed += 1
+def start_profile(client, chat_id, seconds):
+    task = asyncio.create_task(run_profile(client, chat_id, seconds))
+    profile_tasks.add(task)
+    task.add_done_callback(profile_tasks.discard)
+
+async def run_profile(client, chat_id, seconds):
+    try:
+        await send_profile(client, chat_id, seconds)
+    except Exception as e:
+        logger.error(f"Profile for {chat_id} failed: {e}")
+
+LOOP_STALLS = Counter("event_loop_stalls_total", "Times the event loop stayed blocked past the stall threshold")
+loop_watchdog = LoopWatchdog(LOOP_WATCHDOG_INTERVAL, LOOP_STALL_THRESHOLD, LOOP_LAG_WINDOW)
+Gauge("event_loop_lag_seconds", "Latest heartbeat lag of the event loop",
+      read=lambda: loop_watchdog.lags[-1] if loop_watchdog.lags else 0.0)
+Gauge("event_loop_lag_max_seconds", "Worst event loop lag over the watchdog window", read=loop_watchdog.lag)
+
+# Health/ops HTTP server, served from the bot's own event loop: if the loop
+# is wedged the health check stops answering too
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 503: "Service Unavailable"}
+
+class OpsServer:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.routes = {}
+        self.server = None
+
+    def route(self, path):
+        def decorator(func):
+            self.routes[path] = func
+            return func
+        return decorator
+
+    async def start(self):
+        # Worker processes share PORT, the kernel spreads connections over them
+        self.server = await asyncio.start_server(self.handle, self.host, self.port,
+                                                 reuse_port=hasattr(socket, "SO_REUSEPORT"))
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            # Headers are read and ignored, nothing here needs them
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 10)
+                if line in (b"\r\n", b"\n", b""):
+                    break
             
-            # Update progress
-            if sent % 10 == 0 or sent + failed == total:
-                await progress_msg.edit_text(
-                    f"🔄 Promoting...\n{sent + failed}/{total} | Sent: {sent} | Failed: {failed}"
-                )
+            parts = request_line.decode("latin-1").split()
+            if len(parts) < 2:
+                status, content_type, body = 400, "text/plain", "Bad Request"
+            else:
+                method, path = parts[0], parts[1].split("?", 1)[0]
+                handler = self.routes.get(path)
+                if handler is None:
+                    status, content_type, body = 404, "text/plain", "Not Found"
+                elif method not in ("GET", "HEAD"):
+                    status, content_type, body = 405, "text/plain", "Method Not Allowed"
+                else:
+                    status, content_type, body = await handler()
             
-            # Small delay to avoid flooding
-            await asyncio.sleep(0.1)
-        
-        await progress_msg.edit_text(
-            f"✅ **Promotion Completed!**\n\n"
-            f"• Total Users: {total}\n"
-            f"• Promotion Sent: {sent}\n"
-            f"• Failed: {failed}\n"
-            f"• Success Rate: {(sent/total)*100:.1f}%\n\n"
-            f"🎯 Your bot has been promoted to {sent} users!"
-        )
-        
-    except Exception as e:
-        await message.reply_text(f"❌ Promotion error: {str(e)}")
+            payload = body.encode()
+            head = (
+                f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                f"Content-Type: {content_type}; charset=utf-8\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                f"Connection: close\r\n\r\n"
+            )
+            writer.write(head.encode() + (b"" if parts and parts[0] == "HEAD" else payload))
+            await writer.drain()
+        except Exception as e:
+            logger.debug(f"HTTP request failed: {e}")
+        finally:
+            writer.close()
 
-# Simple Flask server for PORT binding
-def create_flask_app():
-    flask_app = Flask(__name__)
-    
-    @flask_app.route('/')
-    def home():
-        return "🤖 String Session Bot is Running!"
-    
-    @flask_app.route('/health')
-    def health():
-        return "OK"
-    
-    return flask_app
+ops_server = OpsServer("0.0.0.0", PORT)
 
-def run_flask():
-    flask_app = create_flask_app()
-    flask_app.run(host='0.0.0.0', port=PORT, debug=False)
+Gauge("live_clients", "Connected per-user MTProto clients in this process", read=lambda: len(live_clients))
+Gauge("login_queue_depth", "Users waiting for a login client slot", read=lambda: len(login_admission.waiters))
+Gauge("login_active", "Users holding a login client slot", read=lambda: len(login_admission.holders))
+Gauge("prewarm_keys", "Pre-generated auth keys ready per library", ("library",),
+      read=lambda: {(library,): len(keys) for library, keys in auth_key_pool.keys.items()})
+Gauge("registration_queue_depth", "/start registrations waiting for the next batch write",
+      read=lambda: len(registration_queue.pending))
+Gauge("broadcast_jobs_running", "Broadcast and promotion jobs running in this process", read=lambda: len(broadcast_tasks))
+Gauge("startup_phase_seconds", "Duration of each startup phase", ("phase",),
+      read=lambda: {(phase,): seconds for phase, seconds in startup_timings.items()})
 
-if __name__ == "__main__":
-    # Initialize database
-    init_db()
+def session_store_sizes():
+    stores = [live_clients, private_sessions]
+    if isinstance(session_backend, MemorySessionBackend):
+        stores.append(session_backend.store)
+    return {(store.name,): len(store) for store in stores}
+
+Gauge("session_store_live", "In-memory session entries held per store", ("store",), read=session_store_sizes)
+
+@ops_server.route("/")
+async def home_page():
+    return 200, "text/plain", "🤖 String Session Bot is Running!"
+
+@ops_server.route("/metrics")
+async def metrics_page():
+    return 200, "text/plain; version=0.0.4", render_metrics()
+
+@ops_server.route("/stalls")
+async def stalls_page():
+    # Stacks captured by the loop watchdog, newest first
+    reports = [
+        f"--- {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stall['at']))}, blocked {stall['blocked']}s\n{stall['stack']}"
+        for stall in reversed(loop_watchdog.stalls)
+    ]
+    return 200, "text/plain", "\n".join(reports) or "No stalls recorded"
+
+@ops_server.route("/health")
+async def health_page():
+    # The heartbeat's worst lag over the last window; a one-off yield here
+    # would only ever see the loop at a moment it was free
+    loop_lag = loop_watchdog.lag()
     
-    # Start Flask server in background thread
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-    logger.info(f"Flask server started on port {PORT}")
+    try:
+        await asyncio.wait_for(user_store.ping(), HEALTH_DB_TIMEOUT)
+        db_ok = True
+    except Exception:
+        db_ok = False
     
-    # Start the bot
-    logger.info("Starting String Session Bot...")
-    print("🤖 Bot is starting...")
+    checks = {
+        "loop_lag": round(loop_lag, 4),
+        "loop_ok": loop_lag < HEALTH_LAG_LIMIT,
+        "loop_stalls": int(LOOP_STALLS.total()),
+        "bot_connected": bool(app.is_connected),
+        "db_ok": db_ok,
+    }
+    healthy = checks["loop_ok"] and checks["bot_connected"] and checks["db_ok"]
+    checks["status"] = "ok" if healthy else "degraded"
+    return (200 if healthy else 503), "application/json", json.dumps(checks)
+
+async def main():
+    # Bind the port first so the platform sees the service come up
+    await ops_server.start()
+    logger.info(f"Ops server started on port {PORT}")
+    loop_watchdog.start()
+    
+    registration_queue.start()
+    live_clients.start()
+    private_sessions.start()
+    await session_backend.start()
     
     try:
-        app.start()
+        started = time.perf_counter()
+        await app.start()
+        mark_startup("app_start", started)
+        if SESSION_BACKEND == "sqlite":
+            await session_relay.start(app)
+        
+        # Replay whatever arrived while the bot was down
+        try:
+            await update_tracker.catch_up(app)
+        except Exception as e:
+            logger.error(f"Update catch-up failed: {e}")
         print("✅ Bot started successfully!")
         
         # Get bot info
-        bot = app.get_me()
+        bot = await bot_profile.get(app, refresh=True)
         print(f"🤖 Bot: @{bot.username}")
         print("🚀 Bot is now running...")
         print(f"👑 Owner: @ShriBots")
         print(f"📊 Database initialized for user tracking")
         
+        # Pick up broadcasts interrupted by the last shutdown, if this
+        # worker gets to run jobs
+        job_leader.start(app)
+        
+        # Background warm-up only once the bot is already serving updates
+        auth_key_pool.start()
+        logger.info(f"Ready ({'persistent' if BOT_SESSION_DIR else 'in-memory'} session): {startup_report()}")
+        
         # Keep the bot running
-        idle()
+        await idle()
         
     except Exception as e:
         logger.error(f"Failed to start bot: {e}")
         print(f"❌ Error: {e}")
     finally:
-        app.stop()
+        await job_leader.stop()
+        await stop_logins()
+        await session_relay.stop()
+        await update_tracker.stop()
+        await session_backend.stop()
+        await live_clients.stop()
+        await private_sessions.stop()
+        await auth_key_pool.stop()
+        if app.is_initialized:
+            await app.stop()
+        # No more updates can arrive, write out whatever is still queued
+        await registration_queue.stop()
+        await loop_watchdog.stop()
+        await ops_server.stop()
         print("🛑 Bot stopped")
+
+if __name__ == "__main__":
+    if BOT_SESSION_DIR:
+        os.makedirs(BOT_SESSION_DIR, exist_ok=True)
+    
+    # Initialize database
+    started = time.perf_counter()
+    user_store.open()
+    mark_startup("db_init", started)
+    
+    # Start the bot
+    logger.info("Starting String Session Bot...")
+    print("🤖 Bot is starting...")
+    
+    try:
+        app.run(main())
+    finally:
+        user_store.close()
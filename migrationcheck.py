@@ -0,0 +1,157 @@
+# Schema migration check on a large pre-versioning users.db.
+#
+# Seeds a database in the layout init_db() used to create (a bare users
+# table, PRAGMA user_version 0) with --users rows, brings it forward with
+# UserStore.open() and reports how long each migration took. It then checks
+# that the schema version, journal mode, user_counts/join_days counters and
+# indexes are what the code expects, that no row was lost, and that opening
+# the migrated file again runs no migration.
+#
+#   python migrationcheck.py --users 3000000
+import os
+import time
+import random
+import logging
+import sqlite3
+import argparse
+import datetime
+import tempfile
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Migrate a seeded pre-versioning users.db and check the result")
+    parser.add_argument("--users", type=int, default=3_000_000, help="users in the seeded database")
+    parser.add_argument("--days", type=int, default=730, help="users joined over this many past days")
+    parser.add_argument("--max-reopen", type=float, default=1.0, help="allowed time to open a migrated file (s)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep", action="store_true", help="leave the database file behind")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's own logging")
+    return parser.parse_args()
+
+args = parse_args()
+
+# main.py reads its configuration at import time
+workdir = tempfile.mkdtemp(prefix="migrationcheck-")
+db_path = os.path.join(workdir, "users.db")
+os.environ["DB_PATH"] = db_path
+
+import main
+
+if not args.verbose:
+    # Quiet the console only, the migration timings are still logged to us
+    for handler in logging.getLogger().handlers:
+        handler.setLevel(logging.WARNING)
+
+# The layout init_db() created before schema versioning
+LEGACY_SCHEMA = '''CREATE TABLE users
+    (user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, last_name TEXT,
+     date_joined TIMESTAMP DEFAULT CURRENT_TIMESTAMP)'''
+LEGACY_INSERT_SQL = "INSERT INTO users (user_id, username, first_name, last_name, date_joined) VALUES (?, ?, ?, ?, ?)"
+
+EXPECTED_INDEXES = ("users_date_joined", "users_status", "users_last_seen", "broadcast_jobs_command")
+EXPECTED_TABLES = ("users", "user_counts", "join_days", "user_generations", "broadcast_jobs",
+                   "broadcast_recipients", "session_states", "leases")
+
+failures = []
+
+def check(ok, text):
+    print(f"{'PASS' if ok else 'FAIL'}  {text}")
+    if not ok:
+        failures.append(text)
+
+def seed():
+    # Telegram-like ids, increasing with gaps; returns new users per day
+    rng = random.Random(args.seed)
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    join_days = {}
+
+    def rows():
+        user_id = 100_000
+        for index in range(args.users):
+            user_id += 1 + rng.randrange(3000)
+            joined = now - datetime.timedelta(seconds=rng.randrange(args.days * 86400))
+            day = joined.strftime("%Y-%m-%d")
+            join_days[day] = join_days.get(day, 0) + 1
+            last_name = None if index % 3 else "Legacy"
+            yield user_id, f"user{index}", "Seed", last_name, joined.strftime("%Y-%m-%d %H:%M:%S")
+
+    conn = sqlite3.connect(db_path)
+    conn.execute(LEGACY_SCHEMA)
+    with conn:
+        conn.executemany(LEGACY_INSERT_SQL, rows())
+    conn.close()
+    return join_days
+
+class MigrationLog(logging.Handler):
+    # Collects the per-step timings UserStore._migrate logs
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    def emit(self, record):
+        message = record.getMessage()
+        if message.startswith("Database migrated"):
+            self.lines.append(message)
+
+def migrate():
+    log = MigrationLog()
+    main.logger.addHandler(log)
+    try:
+        store = main.UserStore(db_path)
+        started = time.perf_counter()
+        store.open()
+        store.close()
+        return time.perf_counter() - started, log.lines, len(store._migrations())
+    finally:
+        main.logger.removeHandler(log)
+
+def verify(join_days, versions):
+    conn = sqlite3.connect(db_path)
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        check(version == versions, f"user_version is {version} ({versions} migrations)")
+        journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        check(journal_mode == "wal", f"journal_mode is {journal_mode}")
+
+        users = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        check(users == args.users, f"every user survived the migration ({users}/{args.users})")
+        counts = dict(conn.execute("SELECT status, users FROM user_counts").fetchall())
+        check(counts == {"active": args.users}, f"user_counts matches the table ({counts})")
+        stored_days = dict(conn.execute("SELECT day, users FROM join_days WHERE users > 0").fetchall())
+        check(stored_days == join_days,
+              f"join_days matches the seeded join dates ({len(stored_days)} days, {sum(stored_days.values())} users)")
+
+        names = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'index')")}
+        missing = [name for name in EXPECTED_TABLES + EXPECTED_INDEXES if name not in names]
+        check(not missing, f"tables and indexes present{f' (missing {missing})' if missing else ''}")
+        triggers = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger'").fetchone()[0]
+        check(triggers >= 4, f"user_counts/join_days triggers present ({triggers})")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    started = time.perf_counter()
+    join_days = seed()
+    size = os.path.getsize(db_path) / 1024 / 1024
+    print(f"Seeded {args.users} users in the pre-versioning layout in {time.perf_counter() - started:.1f}s "
+          f"({size:.0f} MB)")
+
+    seconds, steps, versions = migrate()
+    print(f"Migrated in {seconds:.2f}s:")
+    for line in steps:
+        print(f"  {line}")
+    check(len(steps) == versions, f"every migration ran once ({len(steps)}/{versions})")
+    verify(join_days, versions)
+
+    seconds, steps, _ = migrate()
+    check(not steps and seconds <= args.max_reopen,
+          f"reopening the migrated file runs no migration ({len(steps)} ran, {seconds:.2f}s)")
+
+    if not args.keep:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+        os.rmdir(workdir)
+    if failures:
+        print(f"{len(failures)} check(s) failed")
+        raise SystemExit(1)
+    print("All checks passed")
@@ -0,0 +1,453 @@
+# Two-worker check for SESSION_BACKEND=sqlite.
+#
+# Starts two worker processes on one users.db, each running the real handlers
+# in main.py against an in-process fake Telegram, then checks that:
+#
+# - both workers bind the same ops PORT;
+# - a login flow whose updates alternate between the workers still completes,
+#   and the API hash and phone number never reach users.db;
+# - /cancel on the other worker drops the flow where it lives;
+# - a /broadcast taken by the worker without the job lease is run by the
+#   lease holder, every recipient gets it exactly once, and the combined send
+#   rate stays within BROADCAST_RATE;
+# - when the job runner shuts down mid-broadcast, the other worker takes the
+#   lease and finishes from the checkpoint.
+#
+#   python workertest.py --recipients 600 --rate 50
+#
+# Exits non-zero if any check fails.
+import os
+import sys
+import time
+import json
+import asyncio
+import logging
+import argparse
+import tempfile
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run two bot workers on one database and check they cooperate")
+    parser.add_argument("--recipients", type=int, default=600, help="users the test broadcast goes to")
+    parser.add_argument("--rate", type=float, default=50.0, help="BROADCAST_RATE, messages per second")
+    parser.add_argument("--burst", type=int, default=5, help="BROADCAST_BURST")
+    parser.add_argument("--lease", type=float, default=3.0, help="JOB_LEASE_SECONDS")
+    parser.add_argument("--port", type=int, default=18080, help="ops PORT both workers bind")
+    parser.add_argument("--timeout", type=float, default=120.0, help="give up on a step after this many seconds")
+    parser.add_argument("--verbose", action="store_true", help="keep the workers' own logging")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--dir", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+args = parse_args()
+
+FIRST_RECIPIENT = 20_000_000
+LOGIN_USER = 30_000_001
+CANCEL_USER = 30_000_002
+API_HASH = "0123456789abcdef0123456789abcdef"
+PHONE = "+15550001234"
+owner_id = None  # read from main.py once it is configured
+
+def configure(directory, worker_id=None):
+    # main.py reads its configuration at import time
+    os.environ["DB_PATH"] = os.path.join(directory, "users.db")
+    os.environ["RELAY_DIR"] = os.path.join(directory, "relay")
+    os.environ["SESSION_BACKEND"] = "sqlite"
+    os.environ["PREWARM_POOL_SIZE"] = "0"
+    os.environ["PORT"] = str(args.port)
+    os.environ["BROADCAST_RATE"] = str(args.rate)
+    os.environ["BROADCAST_BURST"] = str(args.burst)
+    os.environ["JOB_LEASE_SECONDS"] = str(args.lease)
+    os.environ["JOB_CHECKPOINT_EVERY"] = "20"
+    os.environ.pop("BOT_SESSION_DIR", None)
+    if worker_id is not None:
+        os.environ["WORKER_ID"] = worker_id
+
+# Worker side: the handlers behind a fake bot, driven by JSON lines on stdin
+
+def emit(event, **fields):
+    sys.stdout.write(json.dumps({"event": event, "worker": args.worker, **fields}) + "\n")
+    sys.stdout.flush()
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.username = f"user{user_id}"
+        self.first_name = "Worker"
+        self.last_name = str(user_id)
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+class FakeMessage:
+    next_id = 1
+
+    def __init__(self, user_id, text=""):
+        self.from_user = FakeUser(user_id)
+        self.chat = FakeChat(user_id)
+        self.text = text
+        self.command = text[1:].split() if text.startswith("/") else None
+        self.reply_to_message = None
+        self.id = FakeMessage.next_id
+        FakeMessage.next_id += 1
+
+    async def reply_text(self, text, **kwargs):
+        emit("reply", user_id=self.chat.id, text=text)
+        return FakeMessage(self.chat.id, text)
+
+    async def edit_text(self, text, **kwargs):
+        emit("reply", user_id=self.chat.id, text=text)
+        return self
+
+class FakeCallbackQuery:
+    def __init__(self, user_id, data):
+        self.from_user = FakeUser(user_id)
+        self.message = FakeMessage(user_id)
+        self.data = data
+
+    async def answer(self, text=None, **kwargs):
+        pass
+
+class FakeBot:
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id >= FIRST_RECIPIENT and chat_id < FIRST_RECIPIENT + args.recipients:
+            emit("sent", user_id=chat_id, at=time.time())
+        else:
+            emit("reply", user_id=chat_id, text=text)
+        return FakeMessage(chat_id, text)
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        emit("reply", user_id=chat_id, text=text)
+
+class FakeSentCode:
+    phone_code_hash = "a1b2c3d4e5f6"
+
+class FakeSession:
+    def save(self):
+        return "1" + "A" * 352
+
+class FakeLoginClient:
+    # One account with 2FA, answering the Pyrogram calls main.py makes
+    def __init__(self):
+        self.is_connected = False
+        self.session = FakeSession()
+
+    async def connect(self):
+        self.is_connected = True
+
+    async def disconnect(self):
+        self.is_connected = False
+
+    async def send_code(self, phone):
+        return FakeSentCode()
+
+    async def sign_in(self, *params, **kwargs):
+        from pyrogram.errors import SessionPasswordNeeded
+        raise SessionPasswordNeeded()
+
+    async def check_password(self, password=None):
+        pass
+
+    async def export_session_string(self):
+        return "B" * 351
+
+    async def send_message(self, chat_id, text):
+        pass
+
+async def serve_worker():
+    import main
+    main.create_pyrogram_client = lambda *params, **kwargs: FakeLoginClient()
+    bot = FakeBot()
+    loop = asyncio.get_running_loop()
+
+    # The same services main() brings up, minus the Telegram connection
+    await main.ops_server.start()
+    main.live_clients.start()
+    main.private_sessions.start()
+    await main.session_backend.start()
+    await main.session_relay.start(bot)
+    main.job_leader.start(bot)
+    emit("ready", pid=os.getpid())
+
+    while True:
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+        if not line:
+            break
+        command = json.loads(line)
+        kind = command["cmd"]
+        if kind == "callback":
+            await main.callback_handler(bot, FakeCallbackQuery(command["user_id"], command["data"]))
+        elif kind == "message":
+            await main.message_handler(bot, FakeMessage(command["user_id"], command["text"]))
+        elif kind == "cancel":
+            await main.cancel_command(bot, FakeMessage(command["user_id"], "/cancel"))
+        elif kind == "broadcast":
+            await main.broadcast_command(bot, FakeMessage(main.OWNER_ID, f"/broadcast {command['text']}"))
+        elif kind == "status":
+            emit("status", leading=main.job_leader.leading, jobs=len(main.broadcast_tasks),
+                 private=len(main.private_sessions), live=len(main.live_clients))
+        elif kind == "stop":
+            break
+
+    await main.job_leader.stop()
+    await main.session_relay.stop()
+    await main.session_backend.stop()
+    await main.private_sessions.stop()
+    await main.live_clients.stop()
+    await main.ops_server.stop()
+    emit("stopped")
+
+def run_worker():
+    configure(args.dir, args.worker)
+    import main
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    main.user_store.open()
+    try:
+        asyncio.run(serve_worker())
+    finally:
+        main.user_store.close()
+
+# Test side
+
+class Worker:
+    def __init__(self, name, directory):
+        self.name = name
+        self.directory = directory
+        self.process = None
+        self.events = asyncio.Queue()
+        self.reader = None
+
+    async def start(self):
+        command = [sys.executable, os.path.abspath(__file__), "--worker", self.name, "--dir", self.directory,
+                   "--recipients", str(args.recipients), "--rate", str(args.rate), "--burst", str(args.burst),
+                   "--lease", str(args.lease), "--port", str(args.port)]
+        if args.verbose:
+            command.append("--verbose")
+        self.process = await asyncio.create_subprocess_exec(
+            *command, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
+        )
+        self.reader = asyncio.create_task(self.read())
+
+    async def read(self):
+        while True:
+            line = await self.process.stdout.readline()
+            if not line:
+                await self.events.put({"event": "exited", "worker": self.name})
+                return
+            try:
+                await self.events.put(json.loads(line))
+            except ValueError:
+                pass
+
+    async def send(self, cmd, **fields):
+        self.process.stdin.write(json.dumps({"cmd": cmd, **fields}).encode() + b"\n")
+        await self.process.stdin.drain()
+
+class Cluster:
+    def __init__(self, workers):
+        self.workers = workers
+        self.events = asyncio.Queue()
+        self.replies = []
+        self.sends = []
+        self.seen = []
+        self.pumps = [asyncio.create_task(self.pump(worker)) for worker in workers]
+
+    async def pump(self, worker):
+        while True:
+            event = await worker.events.get()
+            if event["event"] == "sent":
+                self.sends.append(event)
+            elif event["event"] == "reply":
+                self.replies.append(event)
+            self.seen.append(event)
+            await self.events.put(event)
+
+    async def wait_for(self, accept, what):
+        deadline = time.monotonic() + args.timeout
+        for event in self.seen:
+            if accept(event):
+                return event
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise AssertionError(f"timed out waiting for {what}")
+            event = await asyncio.wait_for(self.events.get(), remaining)
+            if accept(event):
+                return event
+
+    async def wait_reply(self, user_id, fragment):
+        start = len(self.replies)
+        deadline = time.monotonic() + args.timeout
+        while time.monotonic() < deadline:
+            for event in self.replies[start:]:
+                if event["user_id"] == user_id and fragment in event["text"]:
+                    return event
+            await asyncio.sleep(0.02)
+        raise AssertionError(f"no reply containing {fragment!r} for {user_id}")
+
+    async def status(self, worker):
+        await worker.send("status")
+        return await self.wait_for(lambda event: event["event"] == "status" and event["worker"] == worker.name,
+                                   f"status from {worker.name}")
+
+class Checks:
+    def __init__(self):
+        self.failed = 0
+
+    def check(self, ok, text):
+        print(f"{'PASS' if ok else 'FAIL'}  {text}")
+        if not ok:
+            self.failed += 1
+
+def database_bytes(directory):
+    data = b""
+    for suffix in ("", "-wal"):
+        path = os.path.join(directory, "users.db" + suffix)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                data += f.read()
+    return data
+
+async def seed(directory):
+    global owner_id
+    configure(directory)
+    import main
+    owner_id = main.OWNER_ID
+    logging.getLogger().setLevel(logging.WARNING)
+    # Migrate once up front, so the workers don't race to do it
+    main.user_store.open()
+    try:
+        rows = [(user_id, f"user{user_id}", "Recipient", None)
+                for user_id in range(FIRST_RECIPIENT, FIRST_RECIPIENT + args.recipients)]
+        await main.user_store.add_users(rows)
+    finally:
+        main.user_store.close()
+
+async def login_flow(cluster, a, b, checks):
+    # Library choice on A makes A the owner; the other steps alternate
+    await a.send("callback", user_id=LOGIN_USER, data="pyrogram")
+    await cluster.wait_reply(LOGIN_USER, "API_ID")
+    await b.send("message", user_id=LOGIN_USER, text="12345")
+    await cluster.wait_reply(LOGIN_USER, "API_HASH")
+    await b.send("message", user_id=LOGIN_USER, text=API_HASH)
+    await cluster.wait_reply(LOGIN_USER, "PHONE_NUMBER")
+    await a.send("message", user_id=LOGIN_USER, text=PHONE)
+    await cluster.wait_reply(LOGIN_USER, "OTP sent")
+    data = database_bytes(a.directory)
+    checks.check(API_HASH.encode() not in data and PHONE.encode() not in data,
+                 "API hash and phone number are not in users.db")
+    await b.send("message", user_id=LOGIN_USER, text="1 2 3 4 5")
+    await cluster.wait_reply(LOGIN_USER, "two-step verification")
+    await b.send("message", user_id=LOGIN_USER, text="hunter2")
+    event = await cluster.wait_reply(LOGIN_USER, "Session generated successfully")
+    checks.check(event["worker"] == a.name, f"login flow split over both workers completed on its owner ({a.name})")
+    status = await cluster.status(a)
+    checks.check(status["private"] == 0 and status["live"] == 0, "owner dropped the flow's secrets and client")
+
+async def cancel_flow(cluster, a, b, checks):
+    await a.send("callback", user_id=CANCEL_USER, data="pyrogram")
+    await cluster.wait_reply(CANCEL_USER, "API_ID")
+    await a.send("message", user_id=CANCEL_USER, text="12345")
+    await cluster.wait_reply(CANCEL_USER, "API_HASH")
+    await a.send("message", user_id=CANCEL_USER, text=API_HASH)
+    await cluster.wait_reply(CANCEL_USER, "PHONE_NUMBER")
+    await b.send("cancel", user_id=CANCEL_USER)
+    await cluster.wait_reply(CANCEL_USER, "Process cancelled")
+    # The owner drops the flow once the relayed end arrives
+    for _ in range(100):
+        status = await cluster.status(a)
+        if status["private"] == 0:
+            break
+        await asyncio.sleep(0.05)
+    checks.check(status["private"] == 0, "/cancel on the other worker dropped the flow on its owner")
+
+def max_window_sends(sends, window=1.0):
+    times = sorted(event["at"] for event in sends)
+    best = 0
+    start = 0
+    for end in range(len(times)):
+        while times[end] - times[start] > window:
+            start += 1
+        best = max(best, end - start + 1)
+    return best
+
+async def broadcast_flow(cluster, workers, checks):
+    statuses = [await cluster.status(worker) for worker in workers]
+    leaders = [worker for worker, status in zip(workers, statuses) if status["leading"]]
+    checks.check(len(leaders) == 1, f"exactly one worker holds the job lease ({len(leaders)})")
+    leader = leaders[0]
+    follower = next(worker for worker in workers if worker is not leader)
+
+    # Taken by the follower, run by the leader
+    await follower.send("broadcast", text="hello from the two-worker test")
+    await cluster.wait_reply(owner_id, "started...")
+    half = args.recipients // 2
+    await cluster.wait_for(lambda event: len(cluster.sends) >= half, "half of the broadcast")
+    senders = {event["worker"] for event in cluster.sends}
+    checks.check(senders == {leader.name}, f"only the lease holder sends ({', '.join(sorted(senders))})")
+
+    # Shut the runner down mid-job; it checkpoints and hands over the lease
+    stopped_at = time.time()
+    await leader.send("stop")
+    await cluster.wait_for(lambda event: event["event"] == "stopped" and event["worker"] == leader.name,
+                           f"{leader.name} to stop")
+    await cluster.wait_for(lambda event: event["event"] == "sent" and event["worker"] == follower.name,
+                           f"{follower.name} to take over")
+    taken_over = time.time() - stopped_at
+    await cluster.wait_reply(owner_id, "Broadcast Completed")
+
+    user_ids = [event["user_id"] for event in cluster.sends]
+    duplicates = len(user_ids) - len(set(user_ids))
+    missing = args.recipients - len(set(user_ids))
+    checks.check(duplicates == 0, f"no recipient got the broadcast twice ({duplicates} duplicates)")
+    checks.check(missing == 0, f"every recipient got the broadcast ({missing} missing)")
+    peak = max_window_sends(cluster.sends)
+    checks.check(peak <= args.rate + args.burst + 1,
+                 f"peak send rate {peak}/s within BROADCAST_RATE {args.rate:g} + burst {args.burst}")
+    print(f"      {follower.name} took over {taken_over:.1f}s after {leader.name} stopped")
+
+async def run_test():
+    directory = tempfile.mkdtemp(prefix="workertest-")
+    await seed(directory)
+    workers = [Worker("w1", directory), Worker("w2", directory)]
+    for worker in workers:
+        await worker.start()
+    cluster = Cluster(workers)
+    checks = Checks()
+    try:
+        for worker in workers:
+            event = await cluster.wait_for(
+                lambda event, name=worker.name: event["worker"] == name and event["event"] in ("ready", "exited"),
+                f"{worker.name} to start"
+            )
+            checks.check(event["event"] == "ready", f"{worker.name} started and bound port {args.port}")
+        if checks.failed:
+            return checks.failed
+
+        a, b = workers
+        await login_flow(cluster, a, b, checks)
+        await cancel_flow(cluster, a, b, checks)
+        await broadcast_flow(cluster, workers, checks)
+    finally:
+        for worker in workers:
+            if worker.process.returncode is None:
+                try:
+                    await worker.send("stop")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+        for worker in workers:
+            try:
+                await asyncio.wait_for(worker.process.wait(), 10)
+            except asyncio.TimeoutError:
+                worker.process.kill()
+        for pump in cluster.pumps:
+            pump.cancel()
+    print(f"{'All checks passed' if not checks.failed else f'{checks.failed} checks failed'} ({directory})")
+    return checks.failed
+
+if __name__ == "__main__":
+    if args.worker:
+        run_worker()
+    else:
+        sys.exit(1 if asyncio.run(run_test()) else 0)